@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Benchmark the photometry functions and the master-frame / reduction / stacking stages on synthetic FITS frames with injected Gaussian PSF stars.
+# Every stage is timed (wall time) and traced (peak memory by tracemalloc) across stamp size, aperture count, star count and frame count,
+# and the recovered fluxes are checked against the injected ones.
+#
+#   python benchmark_photometry_and_reduction.py [--quick] [--profile]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+from astropy.io    import fits
+from scipy.special import erf
+
+TERM_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path         += [TERM_PROJECT_PATH + "/photometric_measurement", TERM_PROJECT_PATH + "/image_processing"]
+
+from global_functions_library import make_mask_and_compute_background_statistics, make_mask_and_compute_background_statistics_batch, do_aperture_photometric_by_radius, do_aperture_photometric_by_peak_brightness
+from master_frame_library     import make_master_bias, make_master_dark, make_master_flat
+from reduction_library        import reduce_frames
+from stacking_library         import stack_frames
+from profiling_library        import enable_profiling, reset_profile_record, print_profile_report
+
+FWHM                     = 3.0                       # in pixel
+SIGMA_PSF                = FWHM/(8.*np.log(2.))**0.5
+OBJECT_CIRCLE_RADIUS     = 4.0*FWHM
+BACKGROUND_CIRCLE_RADIUS = 8.0*FWHM
+CROP_SIZE                = np.int32(np.ceil(BACKGROUND_CIRCLE_RADIUS)) + 2
+SKY_LEVEL, READ_NOISE    = 100.0, 5.0                # in count
+BIAS_LEVEL, DARK_RATE    = 1000.0, 2.0               # in count and count/second
+TEMPERATURE, EXPOSURE    = -10.0, 10.0               # in degC and second
+BAND_FILTER              = "R"
+FLUX_RELATIVE_TOLERANCE  = 0.02
+STACK_FLUX_TOLERANCE     = 0.003                     # the stack keeps the flux of every frame, a rejection bias at the star cores is larger than this
+
+def add_gaussian_star(image_array: np.array, star_position_array: np.array, star_flux_array: np.array, sigma_psf: np.float64=SIGMA_PSF):
+    # pixel-integrated circular Gaussian PSF (x = column, y = row), only a +-6 sigma box around each star is touched
+    half_size = np.int32(np.ceil(6.0*sigma_psf))
+    for (x, y), flux in zip(star_position_array, star_flux_array):
+        column_start, column_end = max(np.int32(x)-half_size, 0), min(np.int32(x)+half_size+1, image_array.shape[1])
+        row_start,    row_end    = max(np.int32(y)-half_size, 0), min(np.int32(y)+half_size+1, image_array.shape[0])
+        column_edge              = np.arange(column_start, column_end+1) - 0.5
+        row_edge                 = np.arange(row_start,    row_end+1)    - 0.5
+        fraction_x               = np.diff(0.5*erf((column_edge-x)/(2.**0.5*sigma_psf)))
+        fraction_y               = np.diff(0.5*erf((row_edge   -y)/(2.**0.5*sigma_psf)))
+        image_array[row_start:row_end, column_start:column_end] += flux*np.outer(fraction_y, fraction_x)
+    return image_array
+
+def make_star_field(image_size: np.int32, N_star: np.int32, random_generator: np.random.Generator, flux_range: tuple=(2e4, 2e5)) -> tuple:
+    # stars on a jittered grid so that the background annuli do not overlap
+    N_grid               = np.int32(np.ceil(N_star**0.5))
+    grid_step            = (image_size - 2*CROP_SIZE)/N_grid
+    grid_index           = np.arange(N_star)
+    star_position_array  = np.stack([CROP_SIZE + (grid_index %  N_grid + 0.5)*grid_step, CROP_SIZE + (grid_index // N_grid + 0.5)*grid_step], axis=1)
+    star_position_array += random_generator.uniform(-0.5, 0.5, size=star_position_array.shape)
+    star_flux_array      = 10.**random_generator.uniform(np.log10(flux_range[0]), np.log10(flux_range[1]), size=N_star)
+    image_array          = add_gaussian_star(np.full((image_size, image_size), SKY_LEVEL), star_position_array, star_flux_array)
+    image_array          = random_generator.poisson(image_array).astype(np.float64) + random_generator.normal(0.0, READ_NOISE, size=image_array.shape)
+    return image_array, star_position_array, star_flux_array
+
+def measure(function, *args, **kwargs) -> tuple:
+    # (result, wall time in second, peak traced memory in MB)
+    tracemalloc.start()
+    time_start  = time.perf_counter()
+    result      = function(*args, **kwargs)
+    time_elapsed = time.perf_counter() - time_start
+    _, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, time_elapsed, memory_peak/1024.**2
+
+def print_result(stage: str, parameter: str, time_elapsed: np.float64, memory_peak: np.float64, note: str=""):
+    print("%-50s %-22s %12.4e s %10.2f MB  %s"%(stage, parameter, time_elapsed, memory_peak, note))
+
+def measure_star_flux(image_array: np.array, star_position_array: np.array, aperture_radius_array: np.array) -> np.array:
+    flux_list = []
+    for star_position in star_position_array:
+        imag_data_crop, _, object_mask, _, object_center, _, background_mean, background_mean_error, background_std = make_mask_and_compute_background_statistics(image_array, star_position, CROP_SIZE, OBJECT_CIRCLE_RADIUS, BACKGROUND_CIRCLE_RADIUS, 3.0, 5)
+        flux_list.append(do_aperture_photometric_by_radius(imag_data_crop, object_mask, aperture_radius_array, object_center, background_mean, background_mean_error, background_std, return_mask_flag=False)[2])
+    return np.array(flux_list)
+
+def check_flux(flux_recovered: np.array, flux_injected: np.array, tolerance: np.float64=FLUX_RELATIVE_TOLERANCE) -> str:
+    relative_error = np.median(np.abs(flux_recovered/flux_injected - 1.0))
+    return "median |flux ratio - 1| = %.2e (%s)"%(relative_error, "PASS" if relative_error < tolerance else "FAIL")
+
+def benchmark_stamp_size(crop_size_list: list, random_generator: np.random.Generator, N_star: np.int32=20):
+    image_array, star_position_array, _ = make_star_field(1024, N_star, random_generator)
+    pad_size                            = max(crop_size_list)                                   # keep the largest stamps inside the image
+    image_array                         = np.pad(image_array, pad_size, mode="median")
+    star_position_array                 = star_position_array + pad_size
+    for crop_size in crop_size_list:
+        run = lambda: [make_mask_and_compute_background_statistics(image_array, star_position, crop_size, OBJECT_CIRCLE_RADIUS, min(BACKGROUND_CIRCLE_RADIUS, crop_size), 3.0, 5) for star_position in star_position_array]
+        _, time_elapsed, memory_peak = measure(run)
+        print_result("make_mask_and_compute_background_statistics", "crop_size=%d"%crop_size, time_elapsed/N_star, memory_peak, "per star")
+
+def benchmark_aperture_count(aperture_number_list: list, random_generator: np.random.Generator):
+    image_array, star_position_array, star_flux_array = make_star_field(256, 1, random_generator)
+    imag_data_crop, _, object_mask, _, object_center, _, background_mean, background_mean_error, background_std = make_mask_and_compute_background_statistics(image_array, star_position_array[0], CROP_SIZE, OBJECT_CIRCLE_RADIUS, BACKGROUND_CIRCLE_RADIUS, 3.0, 5)
+    for aperture_number in aperture_number_list:
+        aperture_radius_array    = np.linspace(1.0, OBJECT_CIRCLE_RADIUS, aperture_number)
+        aperture_threshold_array = np.linspace(0.0, 1.0, aperture_number)
+        for return_mask_flag in [True, False]:
+            result, time_elapsed, memory_peak = measure(do_aperture_photometric_by_radius, imag_data_crop, object_mask, aperture_radius_array, object_center, background_mean, background_mean_error, background_std, return_mask_flag=return_mask_flag)
+            print_result("do_aperture_photometric_by_radius", "n=%d, mask=%s"%(aperture_number, return_mask_flag), time_elapsed, memory_peak, check_flux(result[2][-1:], star_flux_array))
+            _, time_elapsed, memory_peak = measure(do_aperture_photometric_by_peak_brightness, imag_data_crop, object_mask, aperture_threshold_array, background_mean, background_mean_error, background_std, return_mask_flag=return_mask_flag)
+            print_result("do_aperture_photometric_by_peak_brightness", "n=%d, mask=%s"%(aperture_number, return_mask_flag), time_elapsed, memory_peak)
+        result, time_elapsed, memory_peak = measure(do_aperture_photometric_by_radius, imag_data_crop, object_mask, aperture_radius_array, object_center, background_mean, background_mean_error, background_std, return_mask_flag=False, exact_overlap_flag=True)
+        print_result("do_aperture_photometric_by_radius", "n=%d, exact overlap"%aperture_number, time_elapsed, memory_peak, check_flux(result[2][-1:], star_flux_array))
+
+def benchmark_star_count(star_number_list: list, random_generator: np.random.Generator):
+    for N_star in star_number_list:
+        image_size = np.int32(max(512, 4*CROP_SIZE*np.ceil(N_star**0.5)))
+        image_array, star_position_array, star_flux_array = make_star_field(image_size, N_star, random_generator)
+        flux_loop, time_elapsed, memory_peak = measure(measure_star_flux, image_array, star_position_array, np.array([OBJECT_CIRCLE_RADIUS]))
+        print_result("single-star loop (mask + aperture)", "N_star=%d"%N_star, time_elapsed, memory_peak, check_flux(flux_loop[:,0], star_flux_array))
+        result, time_elapsed, memory_peak = measure(make_mask_and_compute_background_statistics_batch, image_array, star_position_array, CROP_SIZE, OBJECT_CIRCLE_RADIUS, BACKGROUND_CIRCLE_RADIUS, 3.0, 5)
+        imag_data_crop, _, object_mask, _, _, _, background_mean, _, _ = result
+        flux_batch = ((imag_data_crop - background_mean[:,None,None])*object_mask).sum(axis=(1,2))
+        print_result("make_mask_and_compute_background_statistics_batch", "N_star=%d"%N_star, time_elapsed, memory_peak, check_flux(flux_batch, star_flux_array))
+
+def write_synthetic_frame(filename: str, image_array: np.array, image_type: str, exposure: np.float64, band_filter: str=None, object_name: str="SYNTHETIC", integer_flag: bool=True):
+    header = fits.Header()
+    header["IMAGETYP"] = image_type
+    header["OBJECT"]   = object_name
+    header["SET-TEMP"] = TEMPERATURE
+    header["EXPOSURE"] = exposure
+    header["EXPTIME"]  = exposure
+    if band_filter is not None:
+        header["FILTER"] = band_filter
+    # integer frames are unsigned 16 bit as the camera writes them, i.e. stored with BZERO = 32768
+    fits.PrimaryHDU(np.clip(np.round(image_array), 0, 65535).astype(np.uint16) if integer_flag else image_array, header=header).writeto(filename, overwrite=True)
+
+def make_synthetic_night(fits_root_path: str, N_frame: np.int32, image_size: np.int32, random_generator: np.random.Generator, N_star: np.int32=25) -> tuple:
+    # bias, dark, flat and object frames laid out as download_fits.py stores them
+    temperature_str  = "%.0fdegC"%TEMPERATURE
+    exposure_str     = "%.0fsec"%EXPOSURE
+    folder_dict      = {"bias": "%s/bias_field/%s"%(fits_root_path, temperature_str), "dark": "%s/dark_field/%s/%s"%(fits_root_path, temperature_str, exposure_str),
+                        "flat": "%s/flat_field/%s"%(fits_root_path, BAND_FILTER),     "object": "%s/SYNTHETIC_raw/%s"%(fits_root_path, BAND_FILTER)}
+    for folder in folder_dict.values():
+        os.makedirs(folder, exist_ok=True)
+
+    row, column      = np.mgrid[0:image_size, 0:image_size]
+    flat_pattern     = 1.0 + 0.05*(column/image_size - 0.5) + 0.03*(row/image_size - 0.5)
+    _, star_position_array, star_flux_array = make_star_field(image_size, N_star, random_generator)
+    star_image       = add_gaussian_star(np.zeros((image_size, image_size)), star_position_array, star_flux_array)
+    for index in range(N_frame):
+        noise        = lambda: random_generator.normal(0.0, READ_NOISE, size=(image_size, image_size))
+        write_synthetic_frame("%s/bias_%03d.fit"%(folder_dict["bias"], index),     BIAS_LEVEL + noise(),                                                               "Bias Frame", 0.0)
+        write_synthetic_frame("%s/dark_%03d.fit"%(folder_dict["dark"], index),     BIAS_LEVEL + DARK_RATE*EXPOSURE + noise(),                                          "Dark Frame", EXPOSURE)
+        write_synthetic_frame("%s/flat_%03d.fit"%(folder_dict["flat"], index),     BIAS_LEVEL + 2e4*flat_pattern + noise(),                                            "Flat Field", 1.0, BAND_FILTER)
+        write_synthetic_frame("%s/object_%03d.fit"%(folder_dict["object"], index), BIAS_LEVEL + DARK_RATE*EXPOSURE + (star_image + SKY_LEVEL)*flat_pattern + noise(), "Light Frame", EXPOSURE, BAND_FILTER)
+    return folder_dict, star_position_array, star_flux_array
+
+def benchmark_frame_count(frame_number_list: list, random_generator: np.random.Generator, image_size: np.int32=512):
+    for N_frame in frame_number_list:
+        with tempfile.TemporaryDirectory() as fits_root_path:
+            folder_dict, star_position_array, star_flux_array = make_synthetic_night(fits_root_path, N_frame, image_size, random_generator)
+            filename_dict = {key: sorted(os.listdir(folder)) for key, folder in folder_dict.items()}
+            for key, make_master in [("bias", make_master_bias), ("dark", make_master_dark)]:
+                _, time_elapsed, memory_peak = measure(make_master, folder_dict[key], filename_dict[key])
+                print_result(make_master.__name__, "N_frame=%d"%N_frame, time_elapsed, memory_peak)
+            _, time_elapsed, memory_peak = measure(make_master_flat, folder_dict["flat"], filename_dict["flat"], fits_root_path)
+            print_result("make_master_flat", "N_frame=%d"%N_frame, time_elapsed, memory_peak)
+
+            folder_image_corrected = fits_root_path + "/SYNTHETIC_corrected"
+            corrected_filename_list, time_elapsed, memory_peak = measure(reduce_frames, fits_root_path, {folder_dict["object"]: filename_dict["object"]}, folder_image_corrected, max_worker_number=1)
+            with fits.open(corrected_filename_list[0]) as hdul:
+                flux_recovered = measure_star_flux(np.asarray(hdul[0].data, dtype=np.float64), star_position_array, np.array([OBJECT_CIRCLE_RADIUS]))[:,0]
+            print_result("reduce_frames", "N_frame=%d"%N_frame, time_elapsed, memory_peak, check_flux(flux_recovered*EXPOSURE, star_flux_array))
+
+def benchmark_stacking(frame_number_list: list, random_generator: np.random.Generator, image_size: np.int32=256, N_star: np.int32=16, fwhm_range: tuple=(2.5, 4.0), max_shift: np.float64=5.0):
+    # corrected frames (count/second) of one field with random shifts and seeing, stacked onto the first frame; the stacked flux must match the injected one
+    for N_frame in frame_number_list:
+        with tempfile.TemporaryDirectory() as fits_root_path:
+            _, star_position_array, star_flux_array = make_star_field(image_size, N_star, random_generator)
+            offset_array  = random_generator.uniform(-max_shift, max_shift, size=(N_frame, 2))
+            filename_list = []
+            for index, (offset, fwhm) in enumerate(zip(offset_array, random_generator.uniform(*fwhm_range, size=N_frame))):
+                image_array = add_gaussian_star(np.full((image_size, image_size), SKY_LEVEL), star_position_array + offset, star_flux_array, sigma_psf=fwhm/(8.*np.log(2.))**0.5)
+                image_array = random_generator.poisson(image_array).astype(np.float64) + random_generator.normal(0.0, READ_NOISE, size=image_array.shape)
+                filename_list.append("%s/object_%03d_corrected.fit"%(fits_root_path, index))
+                write_synthetic_frame(filename_list[-1], image_array/EXPOSURE, "Light Frame (Corrected)", EXPOSURE, BAND_FILTER, "SYNTHETIC_Corrected", integer_flag=False)
+
+            stacked_filename, time_elapsed, memory_peak = measure(stack_frames, filename_list, fits_root_path + "/SYNTHETIC_stacked.fit")
+            with fits.open(stacked_filename) as hdul:
+                flux_recovered = measure_star_flux(np.array(hdul[0].data, dtype=np.float64), star_position_array + offset_array[0], np.array([OBJECT_CIRCLE_RADIUS]))[:,0]
+            print_result("stack_frames", "N_frame=%d"%N_frame, time_elapsed, memory_peak, check_flux(flux_recovered*EXPOSURE, star_flux_array, STACK_FLUX_TOLERANCE))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark photometry and reduction stages on synthetic frames.")
+    parser.add_argument("--quick",   action="store_true", help="small parameter sweeps")
+    parser.add_argument("--profile", action="store_true", help="enable the profiling hooks and print their report")
+    parser.add_argument("--seed",    type=int, default=20231012)
+    args   = parser.parse_args()
+
+    random_generator = np.random.default_rng(args.seed)
+    if args.profile:
+        enable_profiling()
+        reset_profile_record()
+
+    print("%-50s %-22s %14s %13s  %s"%("stage", "parameter", "wall time", "peak memory", "flux check"))
+    print("-"*130)
+    benchmark_stamp_size([15, 30] if args.quick else [15, 30, 60, 120], random_generator)
+    benchmark_aperture_count([10, 50] if args.quick else [10, 50, 200], random_generator)
+    benchmark_star_count([10, 100] if args.quick else [10, 100, 1000], random_generator)
+    benchmark_frame_count([3, 10] if args.quick else [5, 20, 50], random_generator)
+    benchmark_stacking([4, 10] if args.quick else [5, 20, 50], random_generator)
+
+    if args.profile:
+        print("-"*130)
+        print_profile_report()
+
+if __name__ == '__main__':
+    main()
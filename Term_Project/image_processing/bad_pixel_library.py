@@ -0,0 +1,98 @@
+import os
+import concurrent.futures
+import numpy as np
+
+from astropy.io    import fits
+from astropy.stats import sigma_clipped_stats
+from scipy         import ndimage
+
+from profiling_library import profile_function
+
+LAPLACIAN_KERNEL = np.array([[0., -1., 0.], [-1., 4., -1.], [0., -1., 0.]])
+TILE_MARGIN      = 8    # overlap between tiles, enough for the 7x7 median filters and the mask growing
+
+def compute_robust_statistics(image_array: np.array) -> tuple:
+    # median and MAD based standard deviation, used instead of an iterative sigma_clip over the whole array
+    median = np.nanmedian(image_array)
+    std    = 1.4826*np.nanmedian(np.abs(image_array - median))
+    return median, std
+
+@profile_function
+def make_hot_pixel_mask(master_dark: np.array, how_many_sigma: np.float64=5.0) -> np.array:
+    # hot pixels are the outliers of the master dark
+    median, std = compute_robust_statistics(master_dark)
+    if not std > 0.0:   # MAD = 0 when more than half of the pixels share the median (e.g. a quantized dark); hot pixels only deviate upward,
+        # so the noise is taken from the pixels at and below the median, mirrored and sigma clipped (dead pixels), where the hot pixels cannot inflate it,
+        # and not below the quantization noise 1/sqrt(12) ADU of an integer valued dark
+        lower_deviation = master_dark[master_dark <= median] - median
+        std     = sigma_clipped_stats(np.concatenate([lower_deviation, -lower_deviation[lower_deviation < 0.0]]), sigma=how_many_sigma, maxiters=None)[2]
+        if np.array_equal(master_dark[np.isfinite(master_dark)], np.round(master_dark[np.isfinite(master_dark)])):
+            std = max(std, 12.0**-0.5)
+    return (master_dark - median) > how_many_sigma*std   # std still 0: every unclipped pixel equals the median and only the pixels above it are flagged
+
+def detect_cosmic_ray_tile(image_tile: np.array, gain: np.float64, read_noise: np.float64, sigma_clip_limit: np.float64=4.5, sigma_fraction: np.float64=0.3, object_limit: np.float64=5.0) -> np.array:
+    # L.A.Cosmic (van Dokkum 2001) single pass: Laplacian of the 2x subsampled image, compared with the noise model and with the fine structure image
+    # image_tile is in unit of count (ADU), i.e. before dividing by exposure and flat; gain in e-/ADU (EGAIN of the frame), read_noise in e-
+    image_tile           = np.asarray(image_tile, dtype=np.float64)
+    subsampled_image     = np.repeat(np.repeat(image_tile, 2, axis=0), 2, axis=1)
+    laplacian_image      = ndimage.convolve(subsampled_image, LAPLACIAN_KERNEL, mode="nearest").clip(min=0.0)
+    laplacian_image      = laplacian_image.reshape(image_tile.shape[0], 2, image_tile.shape[1], 2).mean(axis=(1,3))   # rebin to the original size
+
+    median_5_image       = ndimage.median_filter(image_tile, size=5, mode="mirror")
+    noise_image          = np.sqrt(np.clip(gain*median_5_image, 0.0, None) + read_noise**2.0)/gain
+    significance_image   = laplacian_image/(2.0*noise_image)
+    significance_image  -= ndimage.median_filter(significance_image, size=5, mode="mirror")   # remove the smooth structure of extended objects
+    candidate_mask       = significance_image > sigma_clip_limit
+
+    median_3_image       = ndimage.median_filter(image_tile, size=3, mode="mirror")
+    fine_structure_image = np.clip(median_3_image - ndimage.median_filter(median_3_image, size=7, mode="mirror"), 0.01, None)
+    candidate_mask      &= (laplacian_image/fine_structure_image) > object_limit                  # stars are not as sharp as cosmic rays
+
+    # grow into the neighbouring pixels with a lower threshold
+    neighbour_mask       = ndimage.binary_dilation(candidate_mask, structure=np.ones((3,3), dtype=bool))
+    return candidate_mask | (neighbour_mask & (significance_image > sigma_fraction*sigma_clip_limit))
+
+def get_tile_slice_list(image_shape: tuple, tile_size: np.int32) -> list:
+    # (slice with margin, slice of the tile inside the margin, slice of the tile in the full image)
+    tile_slice_list = []
+    for row_start in range(0, image_shape[0], tile_size):
+        for column_start in range(0, image_shape[1], tile_size):
+            row_end, column_end               = min(row_start+tile_size, image_shape[0]), min(column_start+tile_size, image_shape[1])
+            row_start_pad, column_start_pad   = max(row_start-TILE_MARGIN, 0), max(column_start-TILE_MARGIN, 0)
+            row_end_pad, column_end_pad       = min(row_end+TILE_MARGIN, image_shape[0]), min(column_end+TILE_MARGIN, image_shape[1])
+            tile_slice_list.append(( (slice(row_start_pad, row_end_pad), slice(column_start_pad, column_end_pad)),
+                                     (slice(row_start-row_start_pad, row_end-row_start_pad), slice(column_start-column_start_pad, column_end-column_start_pad)),
+                                     (slice(row_start, row_end), slice(column_start, column_end)) ))
+    return tile_slice_list
+
+@profile_function
+def detect_cosmic_ray(image_array: np.array, gain: np.float64, read_noise: np.float64, tile_size: np.int32=512, max_worker_number: np.int32=None, **cosmic_ray_kwargs) -> np.array:
+    # run detect_cosmic_ray_tile on overlapping tiles in a thread pool (scipy.ndimage releases the GIL), only the inner part of each tile is kept
+    cosmic_ray_mask = np.zeros(image_array.shape, dtype=bool)
+    tile_slice_list = get_tile_slice_list(image_array.shape, tile_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_worker_number) as executor:
+        tile_mask_list = executor.map(lambda tile_slice: detect_cosmic_ray_tile(image_array[tile_slice[0]], gain, read_noise, **cosmic_ray_kwargs), tile_slice_list)
+        for tile_slice, tile_mask in zip(tile_slice_list, tile_mask_list):
+            cosmic_ray_mask[tile_slice[2]] = tile_mask[tile_slice[1]]
+    return cosmic_ray_mask
+
+def get_bad_pixel_mask_filename(corrected_filename: str) -> str:
+    # the bad pixel mask is saved next to the corrected FITS, e.g. xxx_corrected.fit -> xxx_corrected_bpm.fit
+    return "%s_bpm.fit"%os.path.splitext(corrected_filename)[0]
+
+def save_bad_pixel_mask(corrected_filename: str, hot_pixel_mask: np.array, cosmic_ray_mask: np.array) -> str:
+    # bit 1: hot pixel from the master dark, bit 2: cosmic ray
+    bad_pixel_mask              = hot_pixel_mask.astype(np.uint8) | (cosmic_ray_mask.astype(np.uint8) << 1)
+    hdu_bad_pixel_mask          = fits.PrimaryHDU(bad_pixel_mask)
+    hdu_bad_pixel_mask.header["IMAGETYP"] = "Bad Pixel Mask"
+    hdu_bad_pixel_mask.header["NOTES"]    = "Bit 1: hot pixel from master dark, bit 2: cosmic ray (L.A.Cosmic)."
+    hdu_bad_pixel_mask.header["N-HOT"]    = (np.int64(hot_pixel_mask.sum()),  "Number of hot pixels")
+    hdu_bad_pixel_mask.header["N-COSMIC"] = (np.int64(cosmic_ray_mask.sum()), "Number of cosmic ray pixels")
+    bad_pixel_mask_filename     = get_bad_pixel_mask_filename(corrected_filename)
+    hdu_bad_pixel_mask.writeto(bad_pixel_mask_filename, overwrite=True) # overwrite the FITS file if it already exists
+    return bad_pixel_mask_filename
+
+def load_bad_pixel_mask(corrected_filename: str) -> np.array:
+    # boolean mask (True = bad) for the corrected FITS, ready for the bad_pixel_mask argument of the photometry functions
+    with fits.open(get_bad_pixel_mask_filename(corrected_filename)) as hdul:
+        return hdul[0].data != 0
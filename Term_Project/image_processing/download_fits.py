@@ -5,6 +5,10 @@ from googleapiclient.http import MediaIoBaseDownload
 
 import os.path
 import io
+import json
+import hashlib
+import threading
+import concurrent.futures
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -16,6 +20,10 @@ from googleapiclient.errors import HttpError
 SCOPES            = ['https://www.googleapis.com/auth/drive']
 storage_root_path = "./FITS_SDSS_Elliptical_Galaxy"
 over_write_flag   = False
+concurrent_flag   = True                                      # download with a thread pool instead of one file at a time
+max_worker_number = 8                                         # number of download threads (each thread owns its Drive service client)
+chunk_size        = 32*1024*1024                              # bytes per ranged request in the concurrent mode
+manifest_filename = "download_manifest.json"                  # stored under storage_root_path, keeps file ID, size and md5Checksum of finished downloads
 
 image_info_dict   = { "SDSS_2258+0017": {"storage_folder_name": "SDSS_2258+0017_raw",
                                          "search_by": "filter",
@@ -63,7 +71,7 @@ def listFiles(service, folder_id, name_keyword_list):
     while True:
         response = service.files().list(
             q=query_string,
-            fields="nextPageToken, files(id, name)",
+            fields="nextPageToken, files(id, name, size, md5Checksum)",
 #            fields="nextPageToken, files(id, name, mimeType)",
             pageToken=page_token,
             includeItemsFromAllDrives=True, 
@@ -96,6 +104,112 @@ def downloadFiles(service, storage_path, listOfFiles):
             status, done = downloader.next_chunk()
             print("Downloading..." + str(fileID['name']))
 
+def nameMatchesKeyword(name, name_keyword):
+    # local stand-in for the Drive "name contains" query, which matches keywords (case-insensitively) at the start of a word
+    name, name_keyword = name.lower(), name_keyword.lower()
+    start = name.find(name_keyword)
+    while start != -1:
+        if start == 0 or not name[start-1].isalnum() or not name_keyword[0].isalnum():
+            return True
+        start = name.find(name_keyword, start+1)
+    return False
+
+def listFilesCached(service, folder_id, name_keyword_list, listing_cache):
+    # one Drive listing per folder ID; the keywords are then filtered locally
+    if folder_id not in listing_cache:
+        listing_cache[folder_id] = listFiles(service, folder_id, [])
+    return [fileID for fileID in listing_cache[folder_id] if all(nameMatchesKeyword(fileID['name'], name_keyword) for name_keyword in name_keyword_list)]
+
+def loadManifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def saveManifest(manifest_path, manifest):
+    # write to a temporary file first so an interrupted run never leaves a broken manifest
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def computeMd5Checksum(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024*1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def isUpToDate(fileID, filename, manifest):
+    # the file is skipped only if the manifest says the same Drive revision (size and md5Checksum) was fully downloaded to the same place
+    record = manifest.get(fileID['id'])
+    if record is None or not os.path.isfile(filename):
+        return False
+    return record['path'] == filename and record['md5Checksum'] == fileID.get('md5Checksum') and os.path.getsize(filename) == int(fileID.get('size', -1))
+
+def downloadByteRange(service, fileID, byte_start, byte_end):
+    # bytes [byte_start, byte_end] of the file; the Range header is set through HttpRequest.headers and the media request returns the body on execute()
+    request                  = service.files().get_media(fileId=fileID['id'])
+    request.headers['Range'] = 'bytes=%d-%d'%(byte_start, byte_end)
+    return request.execute()
+
+def downloadOneFile(service, fileID, filename):
+    # download chunk by chunk into filename.part, so an interrupted run resumes from the size of the partial file
+    partial_filename = filename + '.part'
+    file_size        = int(fileID.get('size', 0))
+    if os.path.isfile(partial_filename) and os.path.getsize(partial_filename) <= file_size:
+        fh = io.FileIO(partial_filename, 'ab')
+    else:
+        fh = io.FileIO(partial_filename, 'wb')
+    try:
+        byte_start = os.path.getsize(partial_filename)
+        while byte_start < file_size:
+            content     = downloadByteRange(service, fileID, byte_start, min(byte_start+chunk_size, file_size)-1)
+            if len(content) == 0:
+                raise RuntimeError("Empty response for %s at byte %d!!"%(str(fileID['name']), byte_start))
+            fh.write(content)
+            byte_start += len(content)
+    finally:
+        fh.close()
+
+    if 'md5Checksum' in fileID and computeMd5Checksum(partial_filename) != fileID['md5Checksum']:
+        os.remove(partial_filename)
+        raise RuntimeError("md5Checksum of %s does not match!! Remove the partial file!!"%str(fileID['name']))
+    os.replace(partial_filename, filename)
+
+def downloadFilesConcurrent(creds, download_job_list, manifest_path, service_factory=None):
+    # download_job_list holds (fileID, storage_path); each worker thread builds its own service since the http client is not thread-safe
+    # service_factory() replaces build('drive', 'v3', credentials=creds), e.g. to run against a local fake Drive service
+    manifest      = loadManifest(manifest_path)
+    manifest_lock = threading.Lock()
+    thread_local  = threading.local()
+
+    def getService():
+        if not hasattr(thread_local, 'service'):
+            thread_local.service = build('drive', 'v3', credentials=creds) if service_factory is None else service_factory()
+        return thread_local.service
+
+    def downloadJob(fileID, filename):
+        downloadOneFile(getService(), fileID, filename)
+        with manifest_lock:
+            manifest[fileID['id']] = {'name': fileID['name'], 'path': filename, 'size': fileID.get('size'), 'md5Checksum': fileID.get('md5Checksum')}
+            saveManifest(manifest_path, manifest)
+        return fileID['name']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_worker_number) as executor:
+        future_dict = {}
+        for fileID, storage_path in download_job_list:
+            filename = storage_path + '/' + fileID['name']
+            if not over_write_flag and isUpToDate(fileID, filename, manifest):
+                print("%s is up to date!! Pass!!"%str(fileID['name']))
+                continue
+            future_dict[executor.submit(downloadJob, fileID, filename)] = fileID['name']
+
+        for future in concurrent.futures.as_completed(future_dict):
+            try:
+                print("Downloaded..." + future.result())
+            except (HttpError, RuntimeError) as error:
+                print("%s failed: %s"%(future_dict[future], error))
+
 def main():
     """Shows basic usage of the Drive v3 API.
     Prints the names and ids of the first 10 files the user has access to.
@@ -120,6 +234,8 @@ def main():
 
     try:
         service = build('drive', 'v3', credentials=creds)
+        listing_cache     = {}
+        download_job_list = []
 
         # Call the Drive v3 API
         for image_type, info_dict in image_info_dict.items():
@@ -127,7 +243,10 @@ def main():
                  list_of_key_word_list  = info_dict["key_word"][search_key]
                  google_drive_folder_id = info_dict["google_folder_id"][search_key]
                  for key_word_list in list_of_key_word_list:
-                     file_list    = listFiles(service, google_drive_folder_id, [".fit"] + [image_type] + key_word_list)
+                     if concurrent_flag:
+                         file_list = listFilesCached(service, google_drive_folder_id, [".fit"] + [image_type] + key_word_list, listing_cache)
+                     else:
+                         file_list = listFiles(service, google_drive_folder_id, [".fit"] + [image_type] + key_word_list)
 #                     print(file_list)
                      if search_key not in key_word_list:
                         storage_path = "%s/%s/%s/%s"%(storage_root_path, info_dict["storage_folder_name"], search_key, "_".join(key_word_list)) 
@@ -139,7 +258,13 @@ def main():
                              os.makedirs("%s"%storage_path)
                          except:
                              raise RuntimeError("Folder %s cannot be creat!!"%storage_path)
-                     downloadFiles(service, storage_path, file_list)
+                     if concurrent_flag:
+                         download_job_list += [(fileID, storage_path) for fileID in file_list]
+                     else:
+                         downloadFiles(service, storage_path, file_list)
+
+        if concurrent_flag:
+            downloadFilesConcurrent(creds, download_job_list, storage_root_path + '/' + manifest_filename)
 
     except HttpError as error:
         # TODO(developer) - Handle errors from drive API.
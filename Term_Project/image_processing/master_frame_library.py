@@ -0,0 +1,179 @@
+import contextlib
+import numpy as np
+
+from astropy.io    import fits
+from astropy.stats import sigma_clip
+from astropy.time  import Time
+
+from profiling_library import profile_function, add_profile_counter
+
+try:
+    import resource   # Unix only
+except ImportError:
+    resource = None
+
+COMBINE_METHOD_LIST = ["mean", "median", "sigma_clip"]
+OPEN_FILE_RESERVE   = 64    # file descriptors left to the rest of the process when FITS files are held open
+
+def get_max_open_file_number(reserved_file_number: np.int32=OPEN_FILE_RESERVE) -> np.int32:
+    # number of FITS files that can be held open at once: a file read through .section takes two descriptors (the file and its memory map)
+    soft_limit = 512 if resource is None else resource.getrlimit(resource.RLIMIT_NOFILE)[0]   # 512: C runtime limit on Windows
+    if resource is not None and soft_limit == resource.RLIM_INFINITY:
+        soft_limit = 2**20
+    return np.int32(max(1, (soft_limit - reserved_file_number)//2))
+
+def get_image_shape_from_hdul_list(folder_path: str, hdul_list: list) -> tuple:
+    image_shape_set = set(hdul[0].shape for hdul in hdul_list)   # only the headers are parsed here, the data are not loaded
+    if len(image_shape_set) != 1:
+        raise RuntimeError("Images under %s do not have the same shape (%s) !! Exit!!"%(folder_path, str(image_shape_set)))
+    return image_shape_set.pop()
+
+def get_image_shape_from_filename_list(folder_path: str, filename_list: list) -> tuple:
+    image_shape_list = []
+    for filename in filename_list:
+        with fits.open(folder_path + "/" + filename) as hdul:
+            image_shape_list.append(hdul[0].shape)   # only the header is parsed here, the data are not loaded
+    if len(set(image_shape_list)) != 1:
+        raise RuntimeError("Images under %s do not have the same shape (%s) !! Exit!!"%(folder_path, str(set(image_shape_list))))
+    return image_shape_list[0]
+
+def get_row_strip_size(N_image: np.int32, N_column: np.int32, max_memory_in_byte: np.int64) -> np.int32:
+    # number of rows such that one (N_image, row_strip_size, N_column) float64 strip stays within max_memory_in_byte
+    return np.int32(max(1, max_memory_in_byte//(8*N_image*N_column)))
+
+@profile_function
+def load_row_strip_from_hdul_list(hdul_list: list, row_start: np.int32, row_end: np.int32, row_strip_array: np.array=None) -> np.array:
+    # rows [row_start, row_end) of every open image into row_strip_array (allocated if not given); .section only reads (and scales by BZERO/BSCALE) the requested rows
+    if row_strip_array is None:
+        row_strip_array = np.empty((len(hdul_list), row_end-row_start, hdul_list[0][0].shape[1]))
+    for image_index, hdul in enumerate(hdul_list):
+        row_strip_array[image_index] = hdul[0].section[row_start:row_end,:]
+    return row_strip_array
+
+@profile_function
+def load_row_strip_from_filename_list(folder_path: str, filename_list: list, row_start: np.int32, row_end: np.int32, N_column: np.int32) -> np.array:
+    # same for more images than get_max_open_file_number(): the files are opened for this strip only, in chunks that can be open at once
+    max_open_file_number = get_max_open_file_number()
+    row_strip_array      = np.empty((len(filename_list), row_end-row_start, N_column))
+    for chunk_start in range(0, len(filename_list), max_open_file_number):
+        with contextlib.ExitStack() as exit_stack:
+            hdul_list    = [exit_stack.enter_context(fits.open(folder_path + "/" + filename)) for filename in filename_list[chunk_start:chunk_start+max_open_file_number]]
+            load_row_strip_from_hdul_list(hdul_list, row_start, row_end, row_strip_array[chunk_start:chunk_start+max_open_file_number])
+    return row_strip_array
+
+@profile_function
+def combine_row_strip(row_strip_array: np.array, combine_method: str, how_many_sigma: np.float64=3.0, max_iter_criteria: np.int32=5) -> np.array:
+    if combine_method == "mean":
+        return row_strip_array.mean(axis=0)
+    elif combine_method == "median":
+        return np.median(row_strip_array, axis=0)
+    elif combine_method == "sigma_clip":
+        clipped_result = sigma_clip(row_strip_array, sigma=how_many_sigma, maxiters=max_iter_criteria, axis=0, masked=True)
+        return clipped_result.mean(axis=0).filled(np.nan)
+    else:
+        raise RuntimeError("combine_method (%s) should be one of %s !! Exit!!"%(combine_method, str(COMBINE_METHOD_LIST)))
+
+@profile_function
+def combine_image_from_filename_list(folder_path: str, filename_list: list, combine_method: str="mean", how_many_sigma: np.float64=3.0, max_iter_criteria: np.int32=5, master_bias: np.array=None, normalize_flag: bool=False, max_memory_in_byte: np.int64=256*1024**2, verbose: bool=False) -> np.array:
+    # combine the images strip by strip, so the peak memory is bounded by max_memory_in_byte instead of growing with the number of images
+    # the files are opened once and held open for the whole combine (both passes), unless there are more than get_max_open_file_number()
+    N_image             = len(filename_list)
+    with contextlib.ExitStack() as exit_stack:
+        if N_image <= get_max_open_file_number():
+            hdul_list   = [exit_stack.enter_context(fits.open(folder_path + "/" + filename)) for filename in filename_list]
+            N_row, N_column = get_image_shape_from_hdul_list(folder_path, hdul_list)
+            load_row_strip  = lambda row_start, row_end: load_row_strip_from_hdul_list(hdul_list, row_start, row_end)
+        else:
+            N_row, N_column = get_image_shape_from_filename_list(folder_path, filename_list)
+            load_row_strip  = lambda row_start, row_end: load_row_strip_from_filename_list(folder_path, filename_list, row_start, row_end, N_column)
+        row_strip_size      = get_row_strip_size(N_image, N_column, max_memory_in_byte)
+        row_start_list      = range(0, N_row, row_strip_size)
+        add_profile_counter("combine_image_from_filename_list", "frame", N_image)
+        if master_bias is not None and master_bias.shape != (N_row, N_column):
+            raise RuntimeError("master_bias shape %s != image shape %s !! Exit!!"%(str(master_bias.shape), str((N_row, N_column))))
+
+        # first pass (only for normalize_flag): mean of each (bias subtracted) image, accumulated strip by strip
+        normalization       = np.ones((N_image,1,1))
+        if normalize_flag:
+            image_sum       = np.zeros(N_image)
+            for row_start in row_start_list:
+                row_end     = min(row_start+row_strip_size, N_row)
+                row_strip   = load_row_strip(row_start, row_end)
+                if master_bias is not None:
+                    row_strip -= master_bias[row_start:row_end]
+                image_sum  += row_strip.sum(axis=(1,2))
+            normalization   = (image_sum/(N_row*N_column)).reshape(-1,1,1)
+
+        # second pass: combine each strip along the image axis
+        master_image        = np.empty((N_row, N_column))
+        for row_start in row_start_list:
+            row_end         = min(row_start+row_strip_size, N_row)
+            row_strip       = load_row_strip(row_start, row_end)
+            if master_bias is not None:
+                row_strip  -= master_bias[row_start:row_end]   # subtract (N_x, N_y) master bias for each image
+            row_strip      /= normalization                    # divided each image by the normalization
+            master_image[row_start:row_end] = combine_row_strip(row_strip, combine_method, how_many_sigma, max_iter_criteria)
+            if verbose:
+                print("Combined rows %d-%d of %d with %d images (%s) ."%(row_start, row_end, N_row, N_image, combine_method))
+
+        if normalize_flag:
+            master_image   /= np.nanmean(master_image)         # do final normalization
+        return master_image
+
+def get_master_header(folder_path: str, filename_list: list, image_type: str, object_name: str, notes: str) -> fits.Header:
+    with fits.open(folder_path + "/" + filename_list[0]) as hdul:
+        header = hdul[0].header.copy()
+
+    time_now                  = Time.now()
+    header["BZERO"]           = 0.0  # important!! Do not shift the np.array value when writing FITS files
+    header["DATE-OBS"]        = (time_now.isot, "YYYY-MM-DDThh:mm:ss processing is done, UT")
+    header["CCD-TEMP"]        = (header["SET-TEMP"],"Set as SET-TEMP for master image")
+    header["IMAGETYP"]        = image_type
+    header["JD"]              = (time_now.jd, "Julian Date for proceesing")
+    header["NOTES"]           = notes
+    header["OBJECT"]          = object_name
+    return header
+
+def make_master_bias(folder_path: str, filename_list: list, combine_method: str="mean", how_many_sigma: np.float64=3.0, max_iter_criteria: np.int32=5, max_memory_in_byte: np.int64=256*1024**2, verbose: bool=False) -> str:
+    # folder_path is .../bias_field/<temperature>, as produced by download_fits.py
+    temperature        = folder_path.rstrip("/").split("/")[-1]
+    master_bias        = combine_image_from_filename_list(folder_path, filename_list, combine_method=combine_method, how_many_sigma=how_many_sigma, max_iter_criteria=max_iter_criteria, max_memory_in_byte=max_memory_in_byte, verbose=verbose)
+    hdu_master_bias    = fits.PrimaryHDU(master_bias)
+    hdu_master_bias.header = get_master_header(folder_path, filename_list, "Bias Frame (Master)", "Bias_Master_%s"%temperature, "Master image obtained by %s combination."%combine_method)
+
+    save_filename      = "%s/Bias-Master_%s.fit"%(folder_path.rstrip("/"),temperature)
+    hdu_master_bias.writeto(save_filename, overwrite=True) # overwrite the FITS file if it already exists
+    return save_filename
+
+def make_master_dark(folder_path: str, filename_list: list, combine_method: str="mean", how_many_sigma: np.float64=3.0, max_iter_criteria: np.int32=5, max_memory_in_byte: np.int64=256*1024**2, verbose: bool=False) -> str:
+    # folder_path is .../dark_field/<temperature>/<exposure>, as produced by download_fits.py
+    temperature        = folder_path.rstrip("/").split("/")[-2]
+    exposure           = folder_path.rstrip("/").split("/")[-1]
+    master_dark        = combine_image_from_filename_list(folder_path, filename_list, combine_method=combine_method, how_many_sigma=how_many_sigma, max_iter_criteria=max_iter_criteria, max_memory_in_byte=max_memory_in_byte, verbose=verbose)
+    hdu_master_dark    = fits.PrimaryHDU(master_dark)
+    hdu_master_dark.header = get_master_header(folder_path, filename_list, "Dark Frame (Master)", "Dark_Master_%s_%s"%(temperature,exposure), "Master image obtained by %s combination."%combine_method)
+
+    save_filename      = "%s/Dark-Master_%s_%s.fit"%(folder_path.rstrip("/"),temperature,exposure)
+    hdu_master_dark.writeto(save_filename, overwrite=True) # overwrite the FITS file if it already exists
+    return save_filename
+
+def make_master_flat(folder_path: str, filename_list: list, fits_root_path: str, combine_method: str="median", how_many_sigma: np.float64=3.0, max_iter_criteria: np.int32=5, max_memory_in_byte: np.int64=256*1024**2, verbose: bool=False) -> str:
+    # folder_path is .../flat_field/<filter>; flats are bias subtracted, normalized to unit mean, combined (median by default to remove the stars in twilight flats) and normalized again
+    band_filter        = folder_path.rstrip("/").split("/")[-1]
+    with fits.open(folder_path + "/" + filename_list[0]) as hdul:
+        temperature_str = "%.0f"%(hdul[0].header["SET-TEMP"])
+
+    with fits.open("%s/bias_field/%sdegC/Bias-Master_%sdegC.fit"%(fits_root_path, temperature_str, temperature_str)) as hdul_master_bias:
+        if np.float64(temperature_str) != np.float64(hdul_master_bias[0].header["SET-TEMP"]):
+            raise RuntimeError( "temperature (%.0f) != master_bias_temperature (%.0f) !! Exit!!"%(np.float64(temperature_str), np.float64(hdul_master_bias[0].header["SET-TEMP"])) )
+        master_bias    = np.array(hdul_master_bias[0].data, dtype=np.float64)
+
+    master_flat        = combine_image_from_filename_list(folder_path, filename_list, combine_method=combine_method, how_many_sigma=how_many_sigma, max_iter_criteria=max_iter_criteria, master_bias=master_bias, normalize_flag=True, max_memory_in_byte=max_memory_in_byte, verbose=verbose)
+    hdu_master_flat    = fits.PrimaryHDU(master_flat)
+    hdu_master_flat.header = get_master_header(folder_path, filename_list, "Flat Field (Master)", "Twilight_Flat_%s_Master_%sdegC"%(band_filter, temperature_str), "Master image obtained by subtracting master bias then %s combined."%combine_method)
+    for key in ["JD-HELIO", "EXPTIME", "EXPOSURE", "OBJCTRA", "OBJCTDEC", "OBJCTALT", "OBJCTAZ", "OBJCTHA", "AIRMASS"]:
+        hdu_master_flat.header[key] = ""
+
+    save_filename      = "%s/Flat-Master_%s.fit"%(folder_path.rstrip("/"),band_filter)
+    hdu_master_flat.writeto(save_filename, overwrite=True) # overwrite the FITS file if it already exists
+    return save_filename
@@ -0,0 +1,72 @@
+import os
+import time
+import functools
+import threading
+
+# opt-in timing/counter instrumentation, enabled by enable_profiling() or by setting the environment variable AAO_PROFILE=1
+PROFILE_FLAG        = os.environ.get("AAO_PROFILE", "0") == "1"
+profile_record_dict = {}    # name -> {"call": number of calls, "time": total wall time (s), "max_time": slowest call (s), counter name: value}
+profile_record_lock = threading.Lock()
+
+def enable_profiling(flag: bool=True):
+    global PROFILE_FLAG
+    PROFILE_FLAG = flag
+
+def is_profiling_enabled() -> bool:
+    return PROFILE_FLAG
+
+def reset_profile_record():
+    with profile_record_lock:
+        profile_record_dict.clear()
+
+def add_profile_counter(name: str, counter_name: str, value: float=1):
+    # e.g. add_profile_counter("reduce_frame_group", "frame", 16); no-op unless profiling is enabled
+    if not PROFILE_FLAG:
+        return
+    with profile_record_lock:
+        record               = profile_record_dict.setdefault(name, {"call": 0, "time": 0.0, "max_time": 0.0})
+        record[counter_name] = record.get(counter_name, 0) + value
+
+def profile_function(function):
+    # records call count and wall time of function under its name; the flag is checked at call time so the overhead is one lookup when disabled
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not PROFILE_FLAG:
+            return function(*args, **kwargs)
+        time_start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            time_elapsed = time.perf_counter() - time_start
+            with profile_record_lock:
+                record              = profile_record_dict.setdefault(function.__name__, {"call": 0, "time": 0.0, "max_time": 0.0})
+                record["call"]     += 1
+                record["time"]     += time_elapsed
+                record["max_time"]  = max(record["max_time"], time_elapsed)
+    return wrapper
+
+def get_profile_record() -> dict:
+    # picklable copy of the records, e.g. returned by a process pool task so the parent can merge it
+    with profile_record_lock:
+        return {name: dict(record) for name, record in profile_record_dict.items()}
+
+def merge_profile_record(record_dict: dict):
+    # add records made elsewhere (process pool workers): calls, times and counters are summed, max_time is the largest
+    with profile_record_lock:
+        for name, record in record_dict.items():
+            merged_record = profile_record_dict.setdefault(name, {"call": 0, "time": 0.0, "max_time": 0.0})
+            for key, value in record.items():
+                merged_record[key] = max(merged_record[key], value) if key == "max_time" else merged_record.get(key, 0) + value
+
+def get_profile_report() -> str:
+    # one line per instrumented function, slowest (total time) first; records of process pool workers are included once merged by merge_profile_record
+    with profile_record_lock:
+        record_list = sorted(profile_record_dict.items(), key=lambda item: -item[1]["time"])
+    line_list = ["%-55s %8s %12s %12s %12s  %s"%("function", "call", "total (s)", "mean (s)", "max (s)", "counter")]
+    for name, record in record_list:
+        counter_str = ", ".join("%s=%g"%(key, value) for key, value in record.items() if key not in ("call", "time", "max_time"))
+        line_list.append("%-55s %8d %12.4e %12.4e %12.4e  %s"%(name, record["call"], record["time"], record["time"]/max(record["call"],1), record["max_time"], counter_str))
+    return "\n".join(line_list)
+
+def print_profile_report():
+    print(get_profile_report())
@@ -0,0 +1,179 @@
+import os
+import functools
+import concurrent.futures
+import numpy as np
+
+from astropy.io   import fits
+from astropy.time import Time
+
+from bad_pixel_library import make_hot_pixel_mask, detect_cosmic_ray, save_bad_pixel_mask
+
+from profiling_library import profile_function, add_profile_counter, enable_profiling, is_profiling_enabled, reset_profile_record, get_profile_record, merge_profile_record
+
+MASTER_CACHE_SIZE           = 3   # master bias, dark and flat of one calibration key kept in memory by each process (tasks sharing a key are submitted together)
+REDUCTION_WORK_FRAME_NUMBER = 2   # float64 frames of temporaries in a worker besides its masters and its cube (FITS reading, exposure*master_flat, cosmic ray tiles)
+
+def get_exposure_filename_str(exposure: np.float64) -> str:
+    if exposure > 60.: return "%.0fmin"%(exposure//60)
+    else:              return "%.0fsec"%(exposure//1)
+
+def get_master_filename_tuple(fits_root_path: str, temperature: np.float64, exposure: np.float64, band_filter: str) -> tuple:
+    # master frame file names follow the naming in master_frame_library.py and pixel_wise_image_correction.ipynb
+    expos_filename_str = get_exposure_filename_str(exposure)
+    master_bias_filename = "%s/bias_field/%.0fdegC/Bias-Master_%.0fdegC.fit"%(fits_root_path, temperature, temperature)
+    master_dark_filename = "%s/dark_field/%.0fdegC/%s/Dark-Master_%.0fdegC_%s.fit"%(fits_root_path, temperature, expos_filename_str, temperature, expos_filename_str)
+    master_flat_filename = "%s/flat_field/%s/Flat-Master_%s.fit"%(fits_root_path, band_filter, band_filter)
+    return master_bias_filename, master_dark_filename, master_flat_filename
+
+@functools.lru_cache(maxsize=MASTER_CACHE_SIZE)
+@profile_function   # under the cache: calls are the cache misses, i.e. the master frames read from disk
+def load_master_frame(filename: str) -> tuple:
+    # cached per process, so a master frame is read from disk once however many frames use it
+    with fits.open(filename) as hdul:
+        master_image  = np.array(hdul[0].data, dtype=np.float64)
+        master_header = hdul[0].header.copy()
+    master_image.setflags(write=False)   # shared by every caller through the cache
+    return master_image, master_header
+
+@functools.lru_cache(maxsize=1)
+@profile_function
+def load_hot_pixel_mask(master_dark_filename: str, how_many_sigma: np.float64=5.0) -> np.array:
+    hot_pixel_mask = make_hot_pixel_mask(load_master_frame(master_dark_filename)[0], how_many_sigma=how_many_sigma)
+    hot_pixel_mask.setflags(write=False)   # shared by every caller through the cache
+    return hot_pixel_mask
+
+def check_master_frame(master_header: fits.Header, temperature: np.float64=None, exposure: np.float64=None, band_filter: str=None, master_type: str="master"):
+    if temperature is not None and temperature != np.float64(master_header["SET-TEMP"]):
+        raise RuntimeError( "temperature (%.0f) != %s_temperature (%.0f) !! Exit!!"%(temperature, master_type, np.float64(master_header["SET-TEMP"])) )
+    if exposure    is not None and exposure    != np.float64(master_header["EXPOSURE"]):
+        raise RuntimeError( "exposure (%.0f)    != %s_exposure    (%.0f) !! Exit!!"%(exposure,    master_type, np.float64(master_header["EXPOSURE"])) )
+    if band_filter is not None and band_filter != master_header["FILTER"]:
+        raise RuntimeError( "band_filter (%s) != %s_band_filter (%s) !! Exit!!"%(band_filter, master_type, master_header["FILTER"]) )
+
+def load_checked_master_frame_tuple(fits_root_path: str, calibration_key: tuple) -> tuple:
+    temperature, exposure, band_filter = calibration_key
+    master_bias_filename, master_dark_filename, master_flat_filename = get_master_filename_tuple(fits_root_path, temperature, exposure, band_filter)
+    master_bias, master_bias_header = load_master_frame(master_bias_filename)
+    master_dark, master_dark_header = load_master_frame(master_dark_filename)
+    master_flat, master_flat_header = load_master_frame(master_flat_filename)
+    check_master_frame(master_bias_header, temperature=temperature,                       master_type="master_bias")
+    check_master_frame(master_dark_header, temperature=temperature, exposure=exposure,    master_type="master_dark")
+    check_master_frame(master_flat_header, band_filter=band_filter,                       master_type="master_flat")
+    return master_bias, master_dark, master_flat
+
+def group_frame_by_calibration_key(folder_image_dict: dict) -> dict:
+    # read only the headers and group the raw frames by (temperature, exposure, filter)
+    frame_group_dict = {}
+    for folder_temp, image_name_list in folder_image_dict.items():
+        for image_name in image_name_list:
+            header          = fits.getheader("%s/%s"%(folder_temp, image_name))
+            calibration_key = (np.float64(header["SET-TEMP"]), np.float64(header["EXPOSURE"]), header["FILTER"])
+            frame_group_dict.setdefault(calibration_key, []).append("%s/%s"%(folder_temp, image_name))
+    return frame_group_dict
+
+def make_corrected_header(object_header: fits.Header) -> fits.Header:
+    header                 = object_header.copy()
+    time_now               = Time.now()
+    header["BZERO"]        = 0.0  # important!! Do not shift the np.array value when writing FITS files
+    header["DATE-PRO"]     = (time_now.isot, "YYYY-MM-DDThh:mm:ss processed, UT")
+    header["CCD-TEMP"]     = (object_header["SET-TEMP"],"Set as SET-TEMP for corrected image")
+    header["IMAGETYP"]     = object_header["IMAGETYP"] + " (Corrected)"
+    header["NOTES"]        = "Corrected image obtained by subtracting master bias and master bias, then divided by master flat."
+    header["OBJECT"]       = object_header["OBJECT"] + "_Corrected"
+    return header
+
+def fix_SDSS2258_header(header: fits.Header, image_filename: str) -> fits.Header:
+    if header["FILTER"] == "B" and "20231012" in image_filename: # somehow the OBJCTRA and OBJCTDEC is missed in fits file for B band on 20231012
+        header["OBJCTRA"]  = ("22 58 00", "Nominal Right Ascension of center of image")
+        header["OBJCTDEC"] = ("+00 17 45", "Nominal Declination of center of image")
+    return header
+
+def get_corrected_filename(folder_image_corrected: str, band_filter: str, image_filename: str) -> str:
+    return "%s/%s/%s_corrected.fit"%(folder_image_corrected, band_filter, os.path.basename(image_filename).split(".")[0])
+
+def get_worker_and_batch_number(frame_size_in_byte: np.int64, N_frame: np.int32, max_worker_number: np.int32, max_memory_in_byte: np.int64) -> tuple:
+    # every worker holds its cached masters, REDUCTION_WORK_FRAME_NUMBER frames of temporaries and a (batch_size, N_row, N_column) float64 cube corrected in place
+    # (+ a boolean cosmic ray mask per frame), all the workers together stay within max_memory_in_byte
+    fixed_size_in_byte       = frame_size_in_byte*(MASTER_CACHE_SIZE + 1.0/8 + REDUCTION_WORK_FRAME_NUMBER)   # 1/8: the boolean hot pixel mask
+    batch_frame_size_in_byte = frame_size_in_byte*(1.0 + 1.0/8)
+    worker_number            = np.int32(max(1, min(max_worker_number or os.cpu_count() or 1, N_frame, max_memory_in_byte//(fixed_size_in_byte + batch_frame_size_in_byte))))
+    batch_size               = np.int32(max(1, min((max_memory_in_byte/worker_number - fixed_size_in_byte)//batch_frame_size_in_byte, -(-N_frame//worker_number))))   # at least one task per worker
+    return worker_number, batch_size
+
+@profile_function
+def reduce_frame_group(fits_root_path: str, folder_image_corrected: str, calibration_key: tuple, image_filename_list: list, fix_header_function=None, bad_pixel_rejection_flag: bool=False, read_noise: np.float64=None, cosmic_ray_kwargs: dict=None) -> list:
+    # correct all the frames sharing one calibration key with broadcast operations done in place on a single (N_image, N_x, N_y) float64 cube
+    # read_noise (in e-, not in the FITS headers) is required for the cosmic ray noise model when bad_pixel_rejection_flag is set, the gain is EGAIN of each frame
+    if bad_pixel_rejection_flag and read_noise is None:
+        raise RuntimeError("read_noise should be given when bad_pixel_rejection_flag is True !! Exit!!")
+    temperature, exposure, band_filter   = calibration_key
+    master_bias, master_dark, master_flat = load_checked_master_frame_tuple(fits_root_path, calibration_key)
+    add_profile_counter("reduce_frame_group", "frame", len(image_filename_list))
+
+    object_header_list         = []
+    object_image_array         = np.empty((len(image_filename_list),) + master_dark.shape)
+    for image_index, image_filename in enumerate(image_filename_list):
+        with fits.open(image_filename) as hdul_object:
+            object_header_list.append(hdul_object[0].header.copy())
+            object_image_array[image_index] = hdul_object[0].data   # copied into the cube before the file is closed
+
+    # ( (object-master_bias) - (master_dark-master_bias) )/exposure/master_flat, the master bias cancels out
+    object_image_array        -= master_dark
+    if bad_pixel_rejection_flag:
+        hot_pixel_mask         = load_hot_pixel_mask(get_master_filename_tuple(fits_root_path, temperature, exposure, band_filter)[1])
+        gain_list              = [np.float64(object_header.get("EGAIN", 1.0)) for object_header in object_header_list]
+        cosmic_ray_mask_list   = [detect_cosmic_ray(object_image_dark_subtracted, gain, read_noise, **({} if cosmic_ray_kwargs is None else cosmic_ray_kwargs)) for object_image_dark_subtracted, gain in zip(object_image_array, gain_list)]   # in count before the flat division, where the noise model holds
+    object_image_array        /= exposure*master_flat
+
+    save_path = "%s/%s/"%(folder_image_corrected, band_filter)
+    os.makedirs(save_path, exist_ok=True)
+    corrected_filename_list    = []
+    for image_index, (image_filename, object_header, object_image_correct) in enumerate(zip(image_filename_list, object_header_list, object_image_array)):
+        header                 = make_corrected_header(object_header)
+        if fix_header_function is not None:
+            header             = fix_header_function(header, image_filename)
+        corrected_filename     = get_corrected_filename(folder_image_corrected, band_filter, image_filename)
+        fits.PrimaryHDU(object_image_correct, header=header).writeto(corrected_filename, overwrite=True) # overwrite the FITS file if it already exists
+        if bad_pixel_rejection_flag:
+            save_bad_pixel_mask(corrected_filename, hot_pixel_mask, cosmic_ray_mask_list[image_index])
+        corrected_filename_list.append(corrected_filename)
+    return corrected_filename_list
+
+def reduce_frame_group_in_worker(profile_flag: bool, *args) -> tuple:
+    # process pool task: the profiling state of the parent is set explicitly (workers may be spawned), and the records made here are returned with the result
+    enable_profiling(profile_flag)
+    reset_profile_record()
+    corrected_filename_list = reduce_frame_group(*args)
+    return corrected_filename_list, get_profile_record()
+
+@profile_function
+def reduce_frames(fits_root_path: str, folder_image_dict: dict, folder_image_corrected: str, max_worker_number: np.int32=None, max_memory_in_byte: np.int64=1024**3, fix_header_function=None, bad_pixel_rejection_flag: bool=False, read_noise: np.float64=None, cosmic_ray_kwargs: dict=None, verbose: bool=False) -> list:
+    # frames are grouped by calibration key and split into batches; every batch is one task of the process pool
+    # the number of workers (at most max_worker_number) and the batch size are chosen so that all the workers stay within max_memory_in_byte
+    frame_group_dict   = group_frame_by_calibration_key(folder_image_dict)
+    N_frame            = sum(len(i) for i in frame_group_dict.values())
+    frame_size_in_byte = max([8*np.int64(header["NAXIS1"])*np.int64(header["NAXIS2"]) for header in [fits.getheader(i[0]) for i in frame_group_dict.values()]], default=1)   # frames of one calibration key share their size
+    worker_number, batch_size = get_worker_and_batch_number(frame_size_in_byte, N_frame, max_worker_number, max_memory_in_byte)
+    task_list        = []
+    for calibration_key in sorted(frame_group_dict.keys(), key=str):   # tasks sharing a key are submitted together so a worker is likely to reuse its cached masters
+        image_filename_list = frame_group_dict[calibration_key]
+        for batch_start in range(0, len(image_filename_list), batch_size):
+            task_list.append((calibration_key, image_filename_list[batch_start:batch_start+batch_size]))
+    if verbose:
+        print("%d frames in %d calibration groups, %d tasks of at most %d frames on %d workers ."%(N_frame, len(frame_group_dict), len(task_list), batch_size, worker_number))
+
+    corrected_filename_list = []
+    if worker_number == 1:
+        for calibration_key, image_filename_list in task_list:
+            corrected_filename_list += reduce_frame_group(fits_root_path, folder_image_corrected, calibration_key, image_filename_list, fix_header_function, bad_pixel_rejection_flag, read_noise, cosmic_ray_kwargs)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=worker_number) as executor:
+            future_list = [executor.submit(reduce_frame_group_in_worker, is_profiling_enabled(), fits_root_path, folder_image_corrected, calibration_key, image_filename_list, fix_header_function, bad_pixel_rejection_flag, read_noise, cosmic_ray_kwargs) for calibration_key, image_filename_list in task_list]
+            for future in future_list:
+                task_corrected_filename_list, profile_record_dict = future.result()
+                corrected_filename_list += task_corrected_filename_list
+                merge_profile_record(profile_record_dict)
+    if verbose:
+        for corrected_filename in corrected_filename_list:
+            print(corrected_filename)
+    return corrected_filename_list
@@ -0,0 +1,183 @@
+import os
+import warnings
+import numpy as np
+
+from astropy.io    import fits
+from astropy.time  import Time
+from astropy.wcs   import WCS
+from scipy         import ndimage
+from scipy.spatial import cKDTree
+
+from bad_pixel_library import compute_robust_statistics, get_bad_pixel_mask_filename
+
+from profiling_library import profile_function, add_profile_counter
+
+REGISTRATION_METHOD_LIST = ["star", "wcs"]
+FOOTPRINT_GROW           = 3    # pixels added around the source footprints where the stack does not reject, also the row overlap between row blocks
+
+def detect_star_position(image_array: np.array, how_many_sigma: np.float64=5.0, max_star_number: np.int32=50, window_size: np.int32=7, window_sigma: np.float64=1.5, max_iter_criteria: np.int32=10) -> np.array:
+    # (N_star, 2) positions (x = column, y = row) of the brightest local maxima above how_many_sigma, refined by the Gaussian windowed centroid
+    # (iterated as SExtractor XWIN_IMAGE/YWIN_IMAGE), which is not pulled toward the pixel center like a plain box centroid
+    median, std     = compute_robust_statistics(image_array)
+    smooth_image    = ndimage.gaussian_filter(np.nan_to_num(image_array - median), sigma=1.0)
+    peak_mask       = (smooth_image == ndimage.maximum_filter(smooth_image, size=window_size)) & (smooth_image > how_many_sigma*std)
+    peak_row, peak_column = np.nonzero(peak_mask[1:-1,1:-1])
+    peak_row, peak_column = peak_row + 1, peak_column + 1
+    brightest_index = np.argsort(smooth_image[peak_row, peak_column])[::-1][:max_star_number]
+    peak_row, peak_column = peak_row[brightest_index], peak_column[brightest_index]
+
+    half_size       = window_size//2
+    offset          = np.arange(-half_size, half_size+1)
+    smooth_image    = np.pad(smooth_image, half_size, mode="constant")   # peaks within half_size of the border get zeros outside the image
+    box             = smooth_image[peak_row[:,None,None]+half_size+offset[None,:,None], peak_column[:,None,None]+half_size+offset[None,None,:]]   # (N_star, window_size, window_size)
+    centroid_x, centroid_y = np.zeros(peak_row.size), np.zeros(peak_row.size)   # relative to the peak pixel
+    for _ in range(max_iter_criteria):
+        weighted_box = box*np.exp(-((offset[None,None,:]-centroid_x[:,None,None])**2.0 + (offset[None,:,None]-centroid_y[:,None,None])**2.0)/(2.0*window_sigma**2.0))
+        weight_sum   = weighted_box.sum(axis=(1,2))
+        shift_x      = 2.0*(weighted_box*(offset[None,None,:]-centroid_x[:,None,None])).sum(axis=(1,2))/weight_sum
+        shift_y      = 2.0*(weighted_box*(offset[None,:,None]-centroid_y[:,None,None])).sum(axis=(1,2))/weight_sum
+        centroid_x, centroid_y = np.clip(centroid_x + shift_x, -1.0, 1.0), np.clip(centroid_y + shift_y, -1.0, 1.0)   # a local maximum is within one pixel of the center
+        if max(np.abs(shift_x).max(initial=0.0), np.abs(shift_y).max(initial=0.0)) < 1e-3:
+            break
+    return np.stack([peak_column + centroid_x, peak_row + centroid_y], axis=1)
+
+def estimate_star_offset(reference_position_array: np.array, frame_position_array: np.array, max_shift: np.float64=100.0, tolerance: np.float64=2.0, min_match_number: np.int32=3) -> np.array:
+    # translation (dx, dy) with frame_position = reference_position + offset: vote over all pairwise differences, then refine with the matched pairs
+    difference_array  = (frame_position_array[None,:,:] - reference_position_array[:,None,:]).reshape(-1,2)
+    difference_array  = difference_array[(np.abs(difference_array) <= max_shift).all(axis=1)]
+    bin_edge          = np.arange(-max_shift, max_shift+tolerance, tolerance)
+    vote, _, _        = np.histogram2d(difference_array[:,0], difference_array[:,1], bins=[bin_edge, bin_edge])
+    vote              = ndimage.convolve(vote, np.array([[1,1,1],[1,2,1],[1,1,1]]), mode="constant")   # votes of the true offset may be split over neighbouring bins, which would let an alias (e.g. one star spacing away) win;
+                                                                                                       # the center weight keeps an unsplit peak above its neighbours, which a flat kernel turns into a plateau
+    vote_index        = np.unravel_index(np.argmax(vote), vote.shape)
+    offset            = np.array([bin_edge[vote_index[0]], bin_edge[vote_index[1]]]) + 0.5*tolerance
+
+    distance, match_index = cKDTree(frame_position_array).query(reference_position_array + offset, k=1, distance_upper_bound=2.0*tolerance)
+    matched_flag      = np.isfinite(distance)
+    if matched_flag.sum() < min_match_number:
+        raise RuntimeError("Only %d stars are matched (< %d) for registration !! Exit!!"%(matched_flag.sum(), min_match_number))
+    return np.median(frame_position_array[match_index[matched_flag]] - reference_position_array[matched_flag], axis=0)
+
+def get_frame_pixel_coordinate(row_start: np.int32, row_end: np.int32, N_column: np.int32, registration: tuple) -> tuple:
+    # (row, column) coordinates in the frame for the reference-grid rows [row_start, row_end)
+    row, column = np.mgrid[row_start:row_end, 0:N_column].astype(np.float64)
+    if registration[0] == "star":
+        offset  = registration[1]
+        return row + offset[1], column + offset[0]
+    else:
+        reference_wcs, frame_wcs = registration[1], registration[2]
+        world_x, world_y         = reference_wcs.all_pix2world(column, row, 0)
+        frame_column, frame_row  = frame_wcs.all_world2pix(world_x, world_y, 0)
+        return frame_row, frame_column
+
+def resample_row_block(filename: str, frame_row: np.array, frame_column: np.array, use_bad_pixel_mask_flag: bool=True) -> np.array:
+    # only the input rows needed by this block are read (memory-mapped section), bad pixels and the area outside the frame become NaN
+    with fits.open(filename, memmap=True) as hdul:
+        N_row, N_column = hdul[0].shape
+        row_start       = np.int32(np.clip(np.floor(np.nanmin(frame_row))-1, 0, N_row))
+        row_end         = np.int32(np.clip(np.ceil(np.nanmax(frame_row))+2,  0, N_row))
+        if row_start >= row_end:
+            return np.full(frame_row.shape, np.nan)
+        image_section   = np.array(hdul[0].section[row_start:row_end,:], dtype=np.float64)
+    bad_pixel_mask_filename = get_bad_pixel_mask_filename(filename)
+    if use_bad_pixel_mask_flag and os.path.isfile(bad_pixel_mask_filename):
+        with fits.open(bad_pixel_mask_filename, memmap=True) as hdul_bad_pixel_mask:
+            image_section[np.asarray(hdul_bad_pixel_mask[0].section[row_start:row_end,:]) != 0] = np.nan
+    return ndimage.map_coordinates(image_section, [frame_row - row_start, frame_column], order=1, mode="constant", cval=np.nan)
+
+@profile_function
+def combine_row_block(row_block_array: np.array, background_array: np.array, variance_array: np.array, gain_exposure_array: np.array, how_many_sigma: np.float64=3.0, footprint_grow: np.int32=FOOTPRINT_GROW) -> tuple:
+    # per-frame inverse-variance weighted mean after rejecting pixels more than how_many_sigma above the median over frames (cosmic rays, satellites are positive),
+    # against the noise model background variance + source Poisson term signal/(gain*exposure) (frames in count per second)
+    # no pixel is rejected inside source footprints (median above how_many_sigma background std, grown by footprint_grow pixels): with the seeing, star cores and wings
+    # differ between frames by much more than the noise, and rejecting them in some frames only would bias the flux; cosmic rays there are masked by the L.A.Cosmic masks
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)   # pixels not covered by any frame are all NaN
+        median_image = np.nanmedian(row_block_array, axis=0)
+    signal_array     = np.clip(median_image[None] - background_array[:,None,None], 0.0, None)
+    footprint_mask   = ndimage.binary_dilation(np.nan_to_num(median_image - np.median(background_array)) > how_many_sigma*np.median(variance_array)**0.5, iterations=footprint_grow)
+    noise_variance   = variance_array[:,None,None] + signal_array/gain_exposure_array[:,None,None]
+    reject_mask      = ((row_block_array - median_image[None]) > how_many_sigma*noise_variance**0.5) & ~footprint_mask[None]
+    weight_array     = np.where(np.isfinite(row_block_array) & ~reject_mask, 1.0/variance_array[:,None,None], 0.0)   # one weight per frame, the flux of a star is kept when the PSF differs between frames
+    weight_sum       = weight_array.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stacked_image = (np.nan_to_num(row_block_array)*weight_array).sum(axis=0)/weight_sum
+    return stacked_image, weight_sum
+
+@profile_function
+def stack_frames(filename_list: list, save_filename: str, registration_method: str="star", how_many_sigma: np.float64=3.0, row_block_size: np.int32=256, use_bad_pixel_mask_flag: bool=True, verbose: bool=False) -> str:
+    # co-add corrected frames of one band onto the grid of the first frame; the stack is built row block by row block so memory stays at N_frame x row_block_size x N_column
+    header_list = [fits.getheader(filename) for filename in filename_list]
+    band_filter_set = set(header["FILTER"] for header in header_list)
+    if len(band_filter_set) != 1:
+        raise RuntimeError("Frames to stack have different FILTER (%s) !! Exit!!"%str(band_filter_set))
+    add_profile_counter("stack_frames", "frame", len(filename_list))
+
+    # per-frame registration and noise: background level and variance from the robust statistics of the frame, gain (EGAIN, e-/ADU) and exposure for the source Poisson term
+    with fits.open(filename_list[0], memmap=True) as hdul:
+        reference_image = np.array(hdul[0].data, dtype=np.float64)
+    N_row, N_column     = reference_image.shape
+    registration_list, background_list, variance_list = [], [], []
+    if registration_method == "star":
+        reference_position_array = detect_star_position(reference_image)
+    elif registration_method == "wcs":
+        reference_wcs            = WCS(header_list[0])
+        if not reference_wcs.has_celestial:
+            raise RuntimeError("%s has no celestial WCS, use registration_method='star' !! Exit!!"%filename_list[0])
+    else:
+        raise RuntimeError("registration_method (%s) should be one of %s !! Exit!!"%(registration_method, str(REGISTRATION_METHOD_LIST)))
+    del reference_image
+
+    for filename, header in zip(filename_list, header_list):
+        with fits.open(filename, memmap=True) as hdul:
+            frame_image  = np.array(hdul[0].data, dtype=np.float64)
+        background, background_std = compute_robust_statistics(frame_image)
+        background_list.append(background)
+        variance_list.append(background_std**2.0)
+        if registration_method == "star":
+            registration_list.append(("star", estimate_star_offset(reference_position_array, detect_star_position(frame_image))))
+        else:
+            registration_list.append(("wcs", reference_wcs, WCS(header)))
+        if verbose:
+            print("%s: registration = %s, noise std = %.4e ."%(filename, str(registration_list[-1][1]) if registration_method == "star" else "WCS", variance_list[-1]**0.5))
+        del frame_image
+    background_array, variance_array = np.array(background_list), np.array(variance_list)
+    gain_exposure_array = np.array([np.float64(header.get("EGAIN", 1.0))*np.float64(header["EXPOSURE"]) for header in header_list])
+
+    stacked_image, weight_image = np.empty((N_row, N_column)), np.empty((N_row, N_column))
+    for row_start in range(0, N_row, row_block_size):
+        row_end          = min(row_start+row_block_size, N_row)
+        row_start_pad, row_end_pad = max(row_start-FOOTPRINT_GROW, 0), min(row_end+FOOTPRINT_GROW, N_row)   # overlap so the footprints near the block edges are complete
+        row_block_array  = np.array([resample_row_block(filename, *get_frame_pixel_coordinate(row_start_pad, row_end_pad, N_column, registration), use_bad_pixel_mask_flag=use_bad_pixel_mask_flag) for filename, registration in zip(filename_list, registration_list)])
+        stacked_block, weight_block = combine_row_block(row_block_array, background_array, variance_array, gain_exposure_array, how_many_sigma)
+        stacked_image[row_start:row_end], weight_image[row_start:row_end] = stacked_block[row_start-row_start_pad:row_end-row_start_pad], weight_block[row_start-row_start_pad:row_end-row_start_pad]
+
+    # keep the header conventions of the corrected frames: FILTER unchanged, EXPOSURE becomes the total exposure (pixel values stay in count per second)
+    header               = header_list[0].copy()
+    time_now             = Time.now()
+    header["BZERO"]      = 0.0  # important!! Do not shift the np.array value when writing FITS files
+    header["DATE-PRO"]   = (time_now.isot, "YYYY-MM-DDThh:mm:ss processed, UT")
+    header["EXPOSURE"]   = np.float64(sum(np.float64(i["EXPOSURE"]) for i in header_list))
+    header["NCOMBINE"]   = (len(filename_list), "Number of stacked frames")
+    header["IMAGETYP"]   = header_list[0]["IMAGETYP"].replace(" (Corrected)", "") + " (Stacked)"
+    header["NOTES"]      = "Stacked image obtained by %s registration, inverse-variance weighted mean with %.1f sigma upper rejection."%(registration_method, how_many_sigma)
+    header["OBJECT"]     = header_list[0]["OBJECT"].replace("_Corrected", "") + "_Stacked"
+    hdu_weight           = fits.ImageHDU(weight_image, name="WEIGHT")
+    hdu_weight.header["NOTES"] = "Sum of inverse-variance weights, 1/WEIGHT is the variance of the stacked pixel."
+    fits.HDUList([fits.PrimaryHDU(stacked_image, header=header), hdu_weight]).writeto(save_filename, overwrite=True) # overwrite the FITS file if it already exists
+    return save_filename
+
+def stack_frames_by_band(folder_image_corrected: str, registration_method: str="star", how_many_sigma: np.float64=3.0, row_block_size: np.int32=256, verbose: bool=False) -> dict:
+    # one stacked image per band from folder_image_corrected/<band>/*_corrected.fit, saved as folder_image_corrected/<band>/<OBJECT>_<band>_stacked.fit
+    stacked_filename_dict = {}
+    for band_filter in sorted(os.listdir(folder_image_corrected)):
+        band_folder   = "%s/%s"%(folder_image_corrected, band_filter)
+        if not os.path.isdir(band_folder):
+            continue
+        filename_list = sorted("%s/%s"%(band_folder, i) for i in os.listdir(band_folder) if i.endswith("_corrected.fit"))
+        if len(filename_list) == 0:
+            continue
+        object_name   = fits.getheader(filename_list[0])["OBJECT"].replace("_Corrected", "")
+        save_filename = "%s/%s_%s_stacked.fit"%(band_folder, object_name, band_filter)
+        stacked_filename_dict[band_filter] = stack_frames(filename_list, save_filename, registration_method=registration_method, how_many_sigma=how_many_sigma, row_block_size=row_block_size, verbose=verbose)
+    return stacked_filename_dict
@@ -0,0 +1,132 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import pytest
+
+pytest.importorskip("googleapiclient")
+pytest.importorskip("google_auth_oauthlib")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import download_fits
+
+OCTET_STREAM = "application/octet-stream"
+
+def drive_name_contains(name, name_keyword):
+    # Drive "name contains": case-insensitive, the keyword words must match consecutive name words, the last one as a prefix
+    name_token, keyword_token = re.findall(r"[a-z0-9]+", name.lower()), re.findall(r"[a-z0-9]+", name_keyword.lower())
+    N_keyword = len(keyword_token)
+    return any(name_token[i:i+N_keyword-1] == keyword_token[:-1] and name_token[i+N_keyword-1].startswith(keyword_token[-1]) for i in range(len(name_token)-N_keyword+1))
+
+class FakeRequest:
+    def __init__(self, execute_function):
+        self.headers  = {}
+        self._execute = execute_function
+
+    def execute(self):
+        return self._execute(self.headers)
+
+class FakeFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, fields, pageToken, includeItemsFromAllDrives, supportsAllDrives):
+        folder_id        = re.search(r"'([^']*)' in parents", q).group(1)
+        mime_type        = re.search(r"mimeType='([^']*)'", q).group(1)
+        name_keyword_list= re.findall(r"name contains '([^']*)'", q)
+        matched_list     = [f for f in self.drive.file_dict.get(folder_id, []) if f["mimeType"] == mime_type and all(drive_name_contains(f["name"], k) for k in name_keyword_list)]
+        page_start       = int(pageToken or 0)
+        if page_start == 0:
+            self.drive.listing_list.append(folder_id)   # one entry per listing, whatever its number of pages
+        page             = matched_list[page_start:page_start+2]   # small pages to go through nextPageToken
+        response         = {"files": [{"id": f["id"], "name": f["name"], "size": str(len(f["content"])), "md5Checksum": f.get("md5Checksum", hashlib.md5(f["content"]).hexdigest())} for f in page]}
+        if page_start+2 < len(matched_list):
+            response["nextPageToken"] = str(page_start+2)
+        return FakeRequest(lambda headers: response)
+
+    def get_media(self, fileId):
+        content = next(f["content"] for file_list in self.drive.file_dict.values() for f in file_list if f["id"] == fileId)
+        def execute(headers):
+            byte_start, byte_end = [int(i) for i in re.match(r"bytes=(\d+)-(\d+)", headers["Range"]).groups()]
+            self.drive.range_request_list.append((fileId, byte_start, byte_end))
+            return content[byte_start:byte_end+1]
+        return FakeRequest(execute)
+
+class FakeDrive:
+    def __init__(self, file_dict):
+        self.file_dict          = file_dict   # folder_id -> list of {"id", "name", "mimeType", "content"[, "md5Checksum"]}
+        self.listing_list       = []
+        self.range_request_list = []
+
+    def files(self):
+        return FakeFiles(self)
+
+def make_file(file_id, name, content, mime_type=OCTET_STREAM, **kwargs):
+    return dict(id=file_id, name=name, content=content, mimeType=mime_type, **kwargs)
+
+FILE_DICT = {"folder_object": [make_file("o1", "SDSS_2258+0017-001_B.fit", b"B-band frame 001 data"),
+                               make_file("o2", "SDSS_2258+0017-002_B.fit", b"B-band frame 002 data!"),
+                               make_file("o3", "SDSS_2258+0017-001B.fit",  b"B not at word start"),
+                               make_file("o4", "SDSS_2258+0017-001_V.fit", b"V-band frame 001"),
+                               make_file("o5", "SDSS_2258+0017-001_I.fit", b"I-band frame 001"),
+                               make_file("o6", "SDSS_2258+0017-001_R.FIT", b"R-band frame upper"),
+                               make_file("o7", "SDSS_2258+0017_notes_B.txt", b"not a fit", mime_type="text/plain")],
+             "folder_flat":   [make_file("f1", "Flat_B_001.fit", b"flat B"),
+                               make_file("f2", "Flat_I_001.fit", b"flat I"),
+                               make_file("f3", "Bias_-10degC_001.fit", b"bias in flat folder")]}
+
+def test_one_listing_per_folder_and_same_keyword_filtering_as_serial_path():
+    keyword_case_list   = [("folder_object", [".fit", "SDSS_2258+0017", band]) for band in ["B", "V", "I", "R"]]\
+                        + [("folder_flat",   [".fit", "Flat", band]) for band in ["B", "V", "I", "R"]]\
+                        + [("folder_flat",   [".fit", "Bias"])]
+    cached_drive, serial_drive, listing_cache = FakeDrive(FILE_DICT), FakeDrive(FILE_DICT), {}
+    for folder_id, name_keyword_list in keyword_case_list:
+        cached_list = download_fits.listFilesCached(cached_drive, folder_id, name_keyword_list, listing_cache)
+        serial_list = download_fits.listFiles(serial_drive, folder_id, name_keyword_list)
+        assert sorted(f["id"] for f in cached_list) == sorted(f["id"] for f in serial_list), (folder_id, name_keyword_list)
+    assert sorted(cached_drive.listing_list) == ["folder_flat", "folder_object"]
+    assert len(serial_drive.listing_list) == len(keyword_case_list)
+
+def run_download(tmp_path, fake_drive, folder_id="folder_object"):
+    storage_path  = str(tmp_path/"storage")
+    os.makedirs(storage_path, exist_ok=True)
+    manifest_path = str(tmp_path/"manifest.json")
+    file_list     = download_fits.listFiles(fake_drive, folder_id, [".fit"])
+    download_fits.downloadFilesConcurrent(None, [(fileID, storage_path) for fileID in file_list], manifest_path, service_factory=lambda: fake_drive)
+    return storage_path, manifest_path, file_list
+
+def test_manifest_skip_and_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_fits, "chunk_size", 4)
+    fake_drive = FakeDrive(FILE_DICT)
+    storage_path, manifest_path, file_list = run_download(tmp_path, fake_drive)
+    content_dict = {f["name"]: f["content"] for f in FILE_DICT["folder_object"]}
+    for fileID in file_list:
+        with open(storage_path + "/" + fileID["name"], "rb") as fh:
+            assert fh.read() == content_dict[fileID["name"]]
+    with open(manifest_path) as manifest_file:
+        assert set(json.load(manifest_file).keys()) == set(f["id"] for f in file_list)
+
+    # unchanged files are skipped through the manifest
+    fake_drive.range_request_list.clear()
+    run_download(tmp_path, fake_drive)
+    assert fake_drive.range_request_list == []
+
+    # an interrupted download continues from the partial file
+    target_filename = storage_path + "/" + file_list[0]["name"]
+    os.remove(target_filename)
+    with open(target_filename + ".part", "wb") as fh:
+        fh.write(content_dict[file_list[0]["name"]][:8])
+    run_download(tmp_path, fake_drive)
+    assert [r for r in fake_drive.range_request_list if r[0] == file_list[0]["id"]][0][1] == 8
+    assert [r[0] for r in fake_drive.range_request_list] == [file_list[0]["id"]]*len(fake_drive.range_request_list)
+    with open(target_filename, "rb") as fh:
+        assert fh.read() == content_dict[file_list[0]["name"]]
+    assert not os.path.exists(target_filename + ".part")
+
+def test_md5_mismatch_removes_partial_file(tmp_path):
+    fake_drive = FakeDrive({"folder_bad": [make_file("b1", "Broken_B_001.fit", b"corrupted content", md5Checksum="0"*32)]})
+    storage_path, manifest_path, _ = run_download(tmp_path, fake_drive, folder_id="folder_bad")
+    assert not os.path.exists(storage_path + "/Broken_B_001.fit")
+    assert not os.path.exists(storage_path + "/Broken_B_001.fit.part")
+    assert download_fits.loadManifest(manifest_path) == {}
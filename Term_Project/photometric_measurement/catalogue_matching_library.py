@@ -0,0 +1,74 @@
+import os
+import hashlib
+import pickle
+import numpy as np
+
+from astropy.io    import ascii
+from scipy.spatial import cKDTree
+
+MATCH_MODE_LIST = ["best", "all"]
+
+def load_apass_catalogue(filename: str) -> np.array:
+    # APASS csv export (e.g. apass_344.49737_0.29520_0.55.csv), missing magnitudes "NA" are filled with NaN
+    return np.genfromtxt(filename, delimiter=",", names=True, dtype=np.float64, missing_values="NA", filling_values=np.nan)
+
+def load_sextractor_catalogue(filename: str):
+    # ASCII_HEAD catalogue written with default.param, columns such as X_WORLD, Y_WORLD, FLUX_APER are available by name
+    return ascii.read(filename, format="sextractor")
+
+def convert_radec_to_unit_vector(ra_deg: np.array, dec_deg: np.array) -> np.array:
+    ra, dec = np.deg2rad(np.asarray(ra_deg, dtype=np.float64)), np.deg2rad(np.asarray(dec_deg, dtype=np.float64))
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)   # (N, 3) on the unit sphere
+
+def convert_arcsec_to_chord_length(angle_arcsec: np.array) -> np.array:
+    return 2.0*np.sin(np.deg2rad(np.asarray(angle_arcsec)/3600.)/2.0)
+
+def convert_chord_length_to_arcsec(chord_length: np.array) -> np.array:
+    return np.rad2deg(2.0*np.arcsin(np.clip(np.asarray(chord_length)/2.0, 0.0, 1.0)))*3600.
+
+def get_catalogue_hash(ra_deg: np.array, dec_deg: np.array) -> str:
+    # the cached index is keyed by the reference coordinates themselves, so an edited catalogue never reuses a stale index
+    coordinate_array = np.ascontiguousarray(np.stack([ra_deg, dec_deg], axis=-1), dtype=np.float64)
+    return hashlib.sha1(coordinate_array.tobytes()).hexdigest()
+
+def build_catalogue_index(ra_deg: np.array, dec_deg: np.array, cache_folder: str=None, verbose: bool=False) -> cKDTree:
+    # KD-tree on unit-sphere coordinates (no RA wrap-around or pole issue); if cache_folder is given the built tree is pickled there and reloaded next time
+    cache_filename = None
+    if cache_folder is not None:
+        cache_filename = "%s/catalogue_index_%s.pkl"%(cache_folder, get_catalogue_hash(ra_deg, dec_deg))
+        if os.path.isfile(cache_filename):
+            if verbose:
+                print("Load catalogue index from %s ."%cache_filename)
+            with open(cache_filename, "rb") as cache_file:
+                return pickle.load(cache_file)
+
+    catalogue_index = cKDTree(convert_radec_to_unit_vector(ra_deg, dec_deg))
+    if cache_filename is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        with open(cache_filename, "wb") as cache_file:
+            pickle.dump(catalogue_index, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        if verbose:
+            print("Save catalogue index to %s ."%cache_filename)
+    return catalogue_index
+
+def match_catalogue(catalogue_index: cKDTree, ra_deg: np.array, dec_deg: np.array, tolerance_arcsec: np.float64=2.0, match_mode: str="best") -> tuple:
+    # match detections (ra_deg, dec_deg) against the indexed reference catalogue
+    #   match_mode = "best": returns (reference_index, separation_arcsec) per detection, unmatched detections have reference_index = -1 and separation = NaN
+    #   match_mode = "all" : returns (detection_index, reference_index, separation_arcsec) for every pair within the tolerance
+    unit_vector        = convert_radec_to_unit_vector(ra_deg, dec_deg).reshape(-1,3)
+    tolerance_chord    = convert_arcsec_to_chord_length(tolerance_arcsec)
+
+    if match_mode == "best":
+        chord_length, reference_index = catalogue_index.query(unit_vector, k=1, distance_upper_bound=tolerance_chord)
+        matched_flag                  = np.isfinite(chord_length)
+        reference_index               = np.where(matched_flag, reference_index, -1)
+        separation_arcsec             = np.where(matched_flag, convert_chord_length_to_arcsec(np.where(matched_flag, chord_length, 0.0)), np.nan)
+        return reference_index, separation_arcsec
+    elif match_mode == "all":
+        reference_index_list          = catalogue_index.query_ball_point(unit_vector, r=tolerance_chord)
+        detection_index               = np.repeat(np.arange(len(reference_index_list)), [len(i) for i in reference_index_list])
+        reference_index               = np.concatenate([np.asarray(i, dtype=np.int64) for i in reference_index_list]) if len(reference_index_list) != 0 else np.array([], dtype=np.int64)
+        chord_length                  = np.linalg.norm(unit_vector[detection_index] - catalogue_index.data[reference_index], axis=-1)
+        return detection_index, reference_index, convert_chord_length_to_arcsec(chord_length)
+    else:
+        raise RuntimeError("match_mode (%s) should be one of %s !! Exit!!"%(match_mode, str(MATCH_MODE_LIST)))
@@ -6,6 +6,8 @@ from astropy.io            import fits
 from astropy.stats         import sigma_clip
 from astropy.visualization import simple_norm
 
+from profiling_library import profile_function, add_profile_counter
+
 def plot_image(image_array: np.array, ax: matplotlib.axes._axes.Axes, v_min:np.float64, v_max: np.float64, cmap: str, norm_type: str, title: str, save_fig_flag: bool=False, save_file_path: str="./", save_dpi: np.int32=512, save_fig_name:str="image"):
     norm         = simple_norm(image_array, stretch=norm_type, percent=100.)
     ax.imshow(image_array, origin='lower', vmin=v_min, vmax=v_max, cmap=cmap)
@@ -15,14 +17,33 @@ def plot_image(image_array: np.array, ax: matplotlib.axes._axes.Axes, v_min:np.f
         save_file_path = "./"
         plt.savefig("%s/%s.png"%(save_file_path,save_fig_name), bbox_inches='tight', dpi=save_dpi, pad_inches=0.02, facecolor='white', transparent=True)
         
-def make_mask_and_compute_background_statistics(imag_array: np.array, object_center_pos_pixel: np.array, crop_size: np.float64, object_circle_radius: np.float64, background_circle_radius: np.float64, how_many_sigma: np.float64, max_iter_criteria: np.float64, pixel_flux_weighted:bool=True) -> tuple:
+def fill_bad_pixel(imag_array: np.array, bad_pixel_mask: np.array, window_size: np.int32=3) -> np.array:
+    # replace bad pixels (cosmic rays, hot pixels) by the median of the good pixels in the window_size x window_size neighbourhood, over the last two axes
+    imag_array_fill                           = np.array(imag_array, dtype=np.float64)
+    if not bad_pixel_mask.any():
+        return imag_array_fill
+    pad_width                                 = [(0,0)]*(imag_array_fill.ndim-2) + [(window_size//2, window_size//2)]*2
+    imag_array_pad                            = np.pad(np.where(bad_pixel_mask, np.nan, imag_array_fill), pad_width, mode="constant", constant_values=np.nan)
+    window_array                              = np.lib.stride_tricks.sliding_window_view(imag_array_pad, (window_size, window_size), axis=(-2,-1))
+    with np.errstate(all="ignore"):
+        imag_array_fill[bad_pixel_mask]       = np.nanmedian(window_array[bad_pixel_mask], axis=(-2,-1))   # NaN if all the neighbours are bad
+    return imag_array_fill
+
+@profile_function
+def make_mask_and_compute_background_statistics(imag_array: np.array, object_center_pos_pixel: np.array, crop_size: np.float64, object_circle_radius: np.float64, background_circle_radius: np.float64, how_many_sigma: np.float64, max_iter_criteria: np.float64, pixel_flux_weighted:bool=True, bad_pixel_mask: np.array=None) -> tuple:
+    # bad_pixel_mask (same shape as imag_array, True = bad, e.g. from bad_pixel_library.load_bad_pixel_mask) is excluded from the background and filled by the neighbour median in the returned crop
     crop_left_edge, crop_right_edge           = np.int32(object_center_pos_pixel[1]) - crop_size, np.int32(object_center_pos_pixel[1]) + crop_size
     crop_down_edge, crop_up_edge              = np.int32(object_center_pos_pixel[0]) - crop_size, np.int32(object_center_pos_pixel[0]) + crop_size
     object_crop_center_pos_pixel              = np.array([object_center_pos_pixel[0]-crop_down_edge, object_center_pos_pixel[1]-crop_left_edge])
 
     # crop the image
     imag_data_crop                            = imag_array[crop_left_edge:crop_right_edge+1, crop_down_edge:crop_up_edge+1]
-    clipped_result                            = sigma_clip(imag_data_crop, sigma=how_many_sigma, maxiters=max_iter_criteria, masked=True)
+    if bad_pixel_mask is not None:
+        bad_pixel_mask_crop                   = bad_pixel_mask[crop_left_edge:crop_right_edge+1, crop_down_edge:crop_up_edge+1]
+        imag_data_crop                        = fill_bad_pixel(imag_data_crop, bad_pixel_mask_crop)
+        clipped_result                        = sigma_clip(np.ma.masked_array(imag_data_crop, mask=bad_pixel_mask_crop), sigma=how_many_sigma, maxiters=max_iter_criteria, masked=True)
+    else:
+        clipped_result                        = sigma_clip(imag_data_crop, sigma=how_many_sigma, maxiters=max_iter_criteria, masked=True)
 
     # make object and background masks for the crop image
     x, y                                      = np.ogrid[0:imag_data_crop.shape[1],0:imag_data_crop.shape[0]][::-1]
@@ -66,76 +87,164 @@ def make_mask_and_compute_background_statistics(imag_array: np.array, object_cen
     else:
         return imag_data_crop, mask_clipped, object_mask, background_mask, object_crop_center_pos_pixel,          background_pixel_count, background_brightness_mean, background_brightness_mean_error, background_brightness_std
 
-def do_aperture_photometric_by_peak_brightness(imag_array: np.array, object_mask: np.array, aperture_threshold_array: np.array, background_brightness_mean: np.float64, background_brightness_mean_error: np.float64, background_brightness_std: np.float64, verbose: bool=False) -> tuple:
+@profile_function
+def make_mask_and_compute_background_statistics_batch(imag_array: np.array, object_center_pos_pixel_array: np.array, crop_size: np.int32, object_circle_radius: np.array, background_circle_radius: np.array, how_many_sigma: np.float64, max_iter_criteria: np.float64, pixel_flux_weighted:bool=True, bad_pixel_mask: np.array=None) -> tuple:
+    # batched version of make_mask_and_compute_background_statistics: object_center_pos_pixel_array is (N_star, 2) and all stamps are handled as one (N_star, 2*crop_size+1, 2*crop_size+1) cube
+    object_center_pos_pixel_array             = np.atleast_2d(np.asarray(object_center_pos_pixel_array, dtype=np.float64))
+    N_star                                    = object_center_pos_pixel_array.shape[0]
+    add_profile_counter("make_mask_and_compute_background_statistics_batch", "star", N_star)
+    crop_size                                 = np.int32(crop_size)
+    object_circle_radius                      = np.broadcast_to(np.asarray(object_circle_radius,     dtype=np.float64), (N_star,)).reshape(-1,1,1)
+    background_circle_radius                  = np.broadcast_to(np.asarray(background_circle_radius, dtype=np.float64), (N_star,)).reshape(-1,1,1)
+
+    crop_left_edge                            = object_center_pos_pixel_array[:,1].astype(np.int32) - crop_size
+    crop_down_edge                            = object_center_pos_pixel_array[:,0].astype(np.int32) - crop_size
+    object_crop_center_pos_pixel_array        = np.stack([object_center_pos_pixel_array[:,0]-crop_down_edge, object_center_pos_pixel_array[:,1]-crop_left_edge], axis=1)
+
+    # crop all the stamps at once (pad the image with NaN so stamps near the edges keep the same shape; NaN pixels are masked by sigma_clip)
+    imag_array_pad                            = np.pad(np.asarray(imag_array, dtype=np.float64), crop_size, mode="constant", constant_values=np.nan)
+    crop_offset                               = np.arange(2*crop_size+1)
+    row_index                                 = (crop_left_edge + crop_size)[:,None] + crop_offset[None,:]
+    column_index                              = (crop_down_edge + crop_size)[:,None] + crop_offset[None,:]
+    if (row_index.min() < 0) or (column_index.min() < 0) or (row_index.max() >= imag_array_pad.shape[0]) or (column_index.max() >= imag_array_pad.shape[1]):
+        raise RuntimeError("Some object centers are outside the image !! Exit!!")
+    imag_data_crop                            = imag_array_pad[row_index[:,:,None], column_index[:,None,:]]
+    if bad_pixel_mask is not None:
+        bad_pixel_mask_crop                   = np.pad(bad_pixel_mask, crop_size, mode="constant", constant_values=False)[row_index[:,:,None], column_index[:,None,:]]
+        imag_data_crop                        = fill_bad_pixel(imag_data_crop, bad_pixel_mask_crop)
+        imag_data_crop                        = np.ma.masked_array(imag_data_crop, mask=bad_pixel_mask_crop)
+    clipped_result                            = sigma_clip(imag_data_crop, sigma=how_many_sigma, maxiters=max_iter_criteria, axis=(1,2), masked=True)
+    imag_data_crop                            = np.ma.getdata(imag_data_crop)
+    clipped_mask                              = np.ma.getmaskarray(clipped_result) | ~np.isfinite(imag_data_crop)
+
+    # make object and background masks for all the crop images
+    y, x                                      = np.ogrid[0:imag_data_crop.shape[1],0:imag_data_crop.shape[2]]
+    x, y                                      = x[None,:,:], y[None,:,:]
+    distance_square                           = (x-object_crop_center_pos_pixel_array[:,0,None,None])**2. + (y-object_crop_center_pos_pixel_array[:,1,None,None])**2.
+    object_mask                               = ( distance_square <= object_circle_radius**2.0 )
+    background_mask                           = ( distance_square >  object_circle_radius**2.0 ) & ( distance_square <= background_circle_radius**2.0 )
+
+    # compute mean background signal
+    mask_clipped                              = ( clipped_mask | object_mask )                    # combine the sigma clipped and target masking
+    background_weight                         = ~mask_clipped & background_mask
+    imag_data_crop_zero_filled                = np.where(np.isfinite(imag_data_crop), imag_data_crop, 0.0)
+    background_pixel_count                    = background_weight.sum(axis=(1,2))
+    background_brightness_mean                = (imag_data_crop_zero_filled*background_weight).sum(axis=(1,2))/background_pixel_count
+
+    # use pixels flux weighted coordinate as real center (we need to subtract the background noise to make the weighting more accurate)
+    if pixel_flux_weighted:
+        weighting                                 = (imag_data_crop_zero_filled-background_brightness_mean[:,None,None])*(object_mask & np.isfinite(imag_data_crop))
+        weighting                                /= weighting.sum(axis=(1,2))[:,None,None]
+        object_crop_center_pos_pixel_array        = np.stack([(x*weighting).sum(axis=(1,2)), (y*weighting).sum(axis=(1,2))], axis=1)
+
+        # remake object and background masks for all the crop images
+        distance_square                           = (x-object_crop_center_pos_pixel_array[:,0,None,None])**2. + (y-object_crop_center_pos_pixel_array[:,1,None,None])**2.
+        object_mask                               = ( distance_square <= object_circle_radius**2.0 )
+        background_mask                           = ( distance_square >  object_circle_radius**2.0 ) & ( distance_square <= background_circle_radius**2.0 )
+
+        # redo background statistics
+        mask_clipped                              = ( clipped_mask | object_mask )                    # combine the sigma clipped and target masking
+        background_weight                         = ~mask_clipped & background_mask
+        background_pixel_count                    = background_weight.sum(axis=(1,2))
+        background_brightness_mean                = (imag_data_crop_zero_filled*background_weight).sum(axis=(1,2))/background_pixel_count
+
+    background_brightness_std                 = ( ((imag_data_crop_zero_filled-background_brightness_mean[:,None,None])**2.*background_weight).sum(axis=(1,2))/background_pixel_count )**0.5
+    background_brightness_mean_error          = background_brightness_std/background_pixel_count**0.5
+
+    return imag_data_crop, mask_clipped, object_mask, background_mask, object_crop_center_pos_pixel_array, background_pixel_count, background_brightness_mean, background_brightness_mean_error, background_brightness_std
+
+@profile_function
+def do_aperture_photometric_by_peak_brightness(imag_array: np.array, object_mask: np.array, aperture_threshold_array: np.array, background_brightness_mean: np.float64, background_brightness_mean_error: np.float64, background_brightness_std: np.float64, verbose: bool=False, return_mask_flag: bool=True) -> tuple:
     data_object                                = imag_array[object_mask]
     data_object                               -= background_brightness_mean   # subtract the background noise 
     brightness_peak                            = data_object.max()
-    
-    aperture_mask_list                         = []
-    aperture_pixel_count_array                 = []
-    brightness_sum_within_aperture_array       = []
-    brightness_sum_error_within_aperture_array = []
-    
-    for threshold in aperture_threshold_array:
-        aperture_criteria                      = threshold*brightness_peak
-        aperture_mask                          = (data_object >= aperture_criteria)
-        aperture_pixel_count                   = aperture_mask.sum()
-        brightness_sum_within_aperture         = data_object[aperture_mask].sum()
-        brightness_sum_error_within_aperture   = (  brightness_sum_within_aperture/background_brightness_mean*background_brightness_std**2.\
-                                                + aperture_pixel_count*background_brightness_std**2.\
-                                                + aperture_pixel_count**2.*background_brightness_mean_error**2.)**0.5  # sum up contribution from source Poisson noise, background Poisson noise and error of the mean background brightness (since we subtract this value)
-        aperture_mask_list.append(aperture_mask.copy())
-        aperture_pixel_count_array.append(aperture_pixel_count)
-        brightness_sum_within_aperture_array.append(brightness_sum_within_aperture)
-        brightness_sum_error_within_aperture_array.append(brightness_sum_error_within_aperture)
-        
-        if verbose:
+    aperture_threshold_array                   = np.asarray(aperture_threshold_array, dtype=np.float64)
+    add_profile_counter("do_aperture_photometric_by_peak_brightness", "aperture", aperture_threshold_array.size)
+
+    # curve of growth: sort the object pixels once by brightness, then every aperture is a prefix of the (descending) sorted pixels
+    data_object_sorted                         = np.sort(data_object)                                                                 # ascending order
+    brightness_cumsum                          = np.concatenate([[0.0], np.cumsum(data_object_sorted[::-1])])                         # cumulative sum from the brightest pixel
+    aperture_criteria_array                    = aperture_threshold_array*brightness_peak
+    aperture_pixel_count_array                 = data_object_sorted.size - np.searchsorted(data_object_sorted, aperture_criteria_array, side="left")  # number of pixels with data_object >= criteria
+    brightness_sum_within_aperture_array       = brightness_cumsum[aperture_pixel_count_array]
+    brightness_sum_error_within_aperture_array = (  brightness_sum_within_aperture_array/background_brightness_mean*background_brightness_std**2.\
+                                                  + aperture_pixel_count_array*background_brightness_std**2.\
+                                                  + aperture_pixel_count_array**2.*background_brightness_mean_error**2.)**0.5  # sum up contribution from source Poisson noise, background Poisson noise and error of the mean background brightness (since we subtract this value)
+
+    # masks are only built on request, since they dominate the memory for a large number of apertures
+    aperture_mask_list                         = [(data_object >= aperture_criteria) for aperture_criteria in aperture_criteria_array] if return_mask_flag else None
+
+    if verbose:
+        for threshold, aperture_pixel_count, brightness_sum_within_aperture, brightness_sum_error_within_aperture in zip(aperture_threshold_array, aperture_pixel_count_array, brightness_sum_within_aperture_array, brightness_sum_error_within_aperture_array):
             print("Aperture threshold = %.4e:"%threshold)
             print("\tPixel counts in the aperture mask is %d ."%aperture_pixel_count)
             print("\tTotal Brightness within the aperture mask is %.4e ± %.4e %s ."%(brightness_sum_within_aperture, brightness_sum_error_within_aperture, "UNIT"))
             print("-"*100)
-        
-    aperture_pixel_count_array                  = np.array(aperture_pixel_count_array)
-    brightness_sum_within_aperture_array        = np.array(brightness_sum_within_aperture_array)
-    brightness_sum_error_within_aperture_array  = np.array(brightness_sum_error_within_aperture_array)
     
     return aperture_mask_list, aperture_pixel_count_array, brightness_sum_within_aperture_array, brightness_sum_error_within_aperture_array, brightness_peak
 
-def do_aperture_photometric_by_radius(imag_array: np.array, object_mask: np.array, aperture_radius_array: np.array, object_center_pos: np.array, background_brightness_mean: np.float64, background_brightness_mean_error: np.float64, background_brightness_std: np.float64, verbose: bool=False) -> tuple:
-    data_object                                = imag_array[object_mask]
-    data_object                               -= background_brightness_mean   # subtract the background noise
+def compute_circle_quadrant_area(x: np.array, y: np.array, radius: np.array) -> np.array:
+    # signed area of the circle of the given radius centered at the origin within the rectangle between (0, 0) and (x, y), negative when x*y < 0
+    x_abs, y_abs   = np.minimum(np.abs(x), radius), np.minimum(np.abs(y), radius)
+    x_cross        = np.minimum(x_abs, (radius**2.0 - y_abs**2.0)**0.5)   # the circle goes below the height y_abs beyond x_cross
+    circle_segment = lambda t: 0.5*(t*np.clip(radius**2.0 - t**2.0, 0.0, None)**0.5 + radius**2.0*np.arcsin(np.clip(t/np.maximum(radius, np.finfo(np.float64).tiny), -1.0, 1.0)))   # integral of (radius^2 - X^2)^0.5 from 0 to t
+    return np.sign(x)*np.sign(y)*(y_abs*x_cross + circle_segment(x_abs) - circle_segment(x_cross))
+
+def compute_circle_pixel_overlap(dx: np.array, dy: np.array, radius: np.array) -> np.array:
+    # exact area of the unit pixels centered at (dx, dy) from the circle center inside the circle (as photutils' "exact" method), by inclusion-exclusion over the pixel corners
+    return   compute_circle_quadrant_area(dx+0.5, dy+0.5, radius) - compute_circle_quadrant_area(dx-0.5, dy+0.5, radius)\
+           - compute_circle_quadrant_area(dx+0.5, dy-0.5, radius) + compute_circle_quadrant_area(dx-0.5, dy-0.5, radius)
+
+@profile_function
+def do_aperture_photometric_by_radius(imag_array: np.array, object_mask: np.array, aperture_radius_array: np.array, object_center_pos: np.array, background_brightness_mean: np.float64, background_brightness_mean_error: np.float64, background_brightness_std: np.float64, verbose: bool=False, return_mask_flag: bool=True, exact_overlap_flag: bool=False) -> tuple:
+    # exact_overlap_flag = False counts the whole pixels of object_mask whose center is inside the aperture;
+    # exact_overlap_flag = True weights every pixel of imag_array touched by the aperture (also outside object_mask) by its exact overlap area with the aperture circle
     xx, yy                                     = np.meshgrid(np.arange(imag_array.shape[0]), np.arange(imag_array.shape[1]), indexing="xy")
-    
-    aperture_mask_list                         = []
-    aperture_pixel_count_array                 = []
-    brightness_sum_within_aperture_array       = []
-    brightness_sum_error_within_aperture_array = []
-
-    for radius in aperture_radius_array:
-        aperture_mask                          = ( (xx[object_mask]-object_center_pos[0])**2.0 + (yy[object_mask]-object_center_pos[1])**2.0 <= radius**2.0 )
-        aperture_pixel_count                   = aperture_mask.sum()
-        brightness_sum_within_aperture         = data_object[aperture_mask].sum()
-        brightness_sum_error_within_aperture   = (  brightness_sum_within_aperture/background_brightness_mean*background_brightness_std**2.\
-                                                  + aperture_pixel_count*background_brightness_std**2.\
-                                                  + aperture_pixel_count**2.*background_brightness_mean_error**2.)**0.5  # sum up contribution from source Poisson noise, background Poisson noise and error of the mean background brightness (since we subtract this value)
-        aperture_mask_list.append(aperture_mask.copy())
-        aperture_pixel_count_array.append(aperture_pixel_count)
-        brightness_sum_within_aperture_array.append(brightness_sum_within_aperture)
-        brightness_sum_error_within_aperture_array.append(brightness_sum_error_within_aperture)
-    
-        if verbose:
+    aperture_radius_array                      = np.asarray(aperture_radius_array, dtype=np.float64)
+    add_profile_counter("do_aperture_photometric_by_radius", "aperture", aperture_radius_array.size)
+
+    if exact_overlap_flag:
+        dx, dy                                 = xx-object_center_pos[0], yy-object_center_pos[1]
+        touched_mask                           = np.clip(np.abs(dx)-0.5, 0.0, None)**2.0 + np.clip(np.abs(dy)-0.5, 0.0, None)**2.0 < aperture_radius_array.max(initial=0.0)**2.0   # nearest point of the pixel inside the largest aperture
+        data_touched                           = imag_array[touched_mask] - background_brightness_mean   # subtract the background noise
+        overlap_array                          = compute_circle_pixel_overlap(dx[touched_mask][None,:], dy[touched_mask][None,:], aperture_radius_array[:,None])   # (N_aperture, N_pixel)
+        aperture_pixel_count_array             = overlap_array.sum(axis=1)
+        brightness_sum_within_aperture_array   = overlap_array @ data_touched
+    else:
+        data_object                            = imag_array[object_mask]
+        data_object                           -= background_brightness_mean   # subtract the background noise
+        distance_square                        = (xx[object_mask]-object_center_pos[0])**2.0 + (yy[object_mask]-object_center_pos[1])**2.0
+        # curve of growth: sort the pixels once by radius, then every aperture is a prefix of the sorted pixels
+        sort_index                             = np.argsort(distance_square, kind="stable")
+        brightness_cumsum                      = np.concatenate([[0.0], np.cumsum(data_object[sort_index])])
+        aperture_pixel_count_array             = np.searchsorted(distance_square[sort_index], aperture_radius_array**2.0, side="right")
+        brightness_sum_within_aperture_array   = brightness_cumsum[aperture_pixel_count_array]
+    brightness_sum_error_within_aperture_array = (  brightness_sum_within_aperture_array/background_brightness_mean*background_brightness_std**2.\
+                                                  + aperture_pixel_count_array*background_brightness_std**2.\
+                                                  + aperture_pixel_count_array**2.*background_brightness_mean_error**2.)**0.5  # sum up contribution from source Poisson noise, background Poisson noise and error of the mean background brightness (since we subtract this value)
+
+    # masks are only built on request: boolean over the object_mask pixels, or with exact_overlap_flag the overlap fraction of every pixel of imag_array
+    if not return_mask_flag:
+        aperture_mask_list                     = None
+    elif exact_overlap_flag:
+        aperture_mask_list                     = [np.zeros(imag_array.shape) for _ in aperture_radius_array]
+        for aperture_mask, overlap in zip(aperture_mask_list, overlap_array):
+            aperture_mask[touched_mask]        = overlap
+    else:
+        aperture_mask_list                     = [(distance_square <= radius**2.0) for radius in aperture_radius_array]
+
+    if verbose:
+        for radius, aperture_pixel_count, brightness_sum_within_aperture, brightness_sum_error_within_aperture in zip(aperture_radius_array, aperture_pixel_count_array, brightness_sum_within_aperture_array, brightness_sum_error_within_aperture_array):
             print("Aperture radius = %.2f:"%radius)
-            print("\tPixel counts in the aperture mask is %d ."%aperture_pixel_count)
+            print("\tPixel counts in the aperture mask is %.2f ."%aperture_pixel_count)
             print("\tTotal Brightness within the aperture mask is %.4e ± %.4e %s ."%(brightness_sum_within_aperture, brightness_sum_error_within_aperture, "UNIT"))
             print("-"*100)
     
-    aperture_pixel_count_array                  = np.array(aperture_pixel_count_array)
-    brightness_sum_within_aperture_array        = np.array(brightness_sum_within_aperture_array)
-    brightness_sum_error_within_aperture_array  = np.array(brightness_sum_error_within_aperture_array)
-    
     return aperture_mask_list, aperture_pixel_count_array, brightness_sum_within_aperture_array, brightness_sum_error_within_aperture_array
 
 def compute_instrumental_magnitude_and_error(pixel_brightness: np.float64, pixel_brightness_error: np.float64) -> tuple:
+    # works element-wise, so the brightness arrays of a whole batch (e.g. (N_band_pair, N_frame, N_star)) can be passed directly
+    pixel_brightness, pixel_brightness_error = np.asarray(pixel_brightness, dtype=np.float64), np.asarray(pixel_brightness_error, dtype=np.float64)
     m_inst       = -5.0/2.0*np.log10(pixel_brightness)
     m_inst_error =  5.0/(2.0*np.log(10))*(pixel_brightness_error/pixel_brightness)
     return m_inst, m_inst_error
@@ -152,4 +261,85 @@ def color_term_fitting_error(m_inst_lambda1: np.float64, m_inst_lambda2: np.floa
 def residual_function(params: list, data: tuple) -> np.array:
     x_1, x_2, y, weight = data
     beta, gamma         = params[0], params[1]
-    return ( y-color_term_fitting(m_inst_lambda1=x_1, m_inst_lambda2=x_2, beta=beta, gamma=gamma) )/weight  # Squaring will be taken by kmpfit function
\ No newline at end of file
+    return ( y-color_term_fitting(m_inst_lambda1=x_1, m_inst_lambda2=x_2, beta=beta, gamma=gamma) )/weight  # Squaring will be taken by kmpfit function
+
+COLOR_TERM_REFIT_MODE_LIST = ["none", "sigma_clip", "bootstrap"]
+
+@profile_function
+def color_term_fitting_batch(m_inst_lambda1: np.array, m_inst_lambda2: np.array, m_true_lambda1: np.array, weight: np.array, valid_mask: np.array=None, absolute_weight_flag: bool=False) -> tuple:
+    # closed-form weighted least squares of m_true_lambda1 = m_inst_lambda1 + beta*(m_inst_lambda1-m_inst_lambda2) + gamma
+    # all inputs are (..., N_star), e.g. (N_band_pair, N_frame, N_star); every leading index is an independent fit, and weight plays the same role as in residual_function (residual/weight)
+    # invalid stars (NaN, or valid_mask False) get zero weight so fits with different numbers of stars can share one array
+    color            = np.asarray(m_inst_lambda1, dtype=np.float64) - np.asarray(m_inst_lambda2, dtype=np.float64)
+    target           = np.asarray(m_true_lambda1, dtype=np.float64) - np.asarray(m_inst_lambda1, dtype=np.float64)
+    inverse_variance = 1.0/np.asarray(weight, dtype=np.float64)**2.0
+    valid            = np.isfinite(color) & np.isfinite(target) & np.isfinite(inverse_variance)
+    if valid_mask is not None:
+        valid       &= valid_mask
+    inverse_variance = np.where(valid, inverse_variance, 0.0)
+    color, target    = np.where(valid, color, 0.0), np.where(valid, target, 0.0)
+
+    S, S_x, S_xx     = inverse_variance.sum(axis=-1), (inverse_variance*color).sum(axis=-1), (inverse_variance*color**2.0).sum(axis=-1)
+    S_y, S_xy        = (inverse_variance*target).sum(axis=-1), (inverse_variance*color*target).sum(axis=-1)
+    determinant      = S*S_xx - S_x**2.0
+    beta             = (S*S_xy  - S_x*S_y )/determinant
+    gamma            = (S_xx*S_y - S_x*S_xy)/determinant
+
+    # covariance of (beta, gamma) is the inverse of the normal matrix; unless absolute_weight_flag, scale it by the reduced chi-square (as kmpfit's stderr does)
+    degree_of_freedom = valid.sum(axis=-1) - 2
+    chi2             = (inverse_variance*(target - beta[...,None]*color - gamma[...,None])**2.0).sum(axis=-1)
+    reduced_chi2     = chi2/np.where(degree_of_freedom > 0, degree_of_freedom, np.nan)
+    covariance       = np.stack([np.stack([S, -S_x], axis=-1), np.stack([-S_x, S_xx], axis=-1)], axis=-2)/determinant[...,None,None]
+    if not absolute_weight_flag:
+        covariance  *= reduced_chi2[...,None,None]
+    beta_error, gamma_error = covariance[...,0,0]**0.5, covariance[...,1,1]**0.5
+    return beta, gamma, beta_error, gamma_error, covariance, reduced_chi2
+
+def color_term_fitting_batch_with_refit(m_inst_lambda1: np.array, m_inst_lambda2: np.array, m_true_lambda1: np.array, weight: np.array, refit_mode: str="sigma_clip", how_many_sigma: np.float64=3.0, max_iter_criteria: np.int32=5, bootstrap_number: np.int32=1000, random_seed: np.int32=None, absolute_weight_flag: bool=False) -> tuple:
+    # refit_mode = "sigma_clip": iteratively drop stars whose |residual/weight| exceeds how_many_sigma times the std of the normalized residuals, for all fits at once
+    # refit_mode = "bootstrap" : errors and covariance are those of beta/gamma over bootstrap_number resamplings of the stars, evaluated as one extra batch axis
+    m_inst_lambda1, m_inst_lambda2 = np.asarray(m_inst_lambda1, dtype=np.float64), np.asarray(m_inst_lambda2, dtype=np.float64)
+    m_true_lambda1, weight         = np.asarray(m_true_lambda1, dtype=np.float64), np.asarray(weight, dtype=np.float64)
+    valid_mask                     = np.ones(m_inst_lambda1.shape, dtype=bool)
+    fit_result                     = color_term_fitting_batch(m_inst_lambda1, m_inst_lambda2, m_true_lambda1, weight, valid_mask, absolute_weight_flag)
+
+    if refit_mode == "none":
+        return fit_result + (valid_mask,)
+    elif refit_mode == "sigma_clip":
+        for _ in range(max_iter_criteria):
+            beta, gamma             = fit_result[0], fit_result[1]
+            residual                = ( m_true_lambda1-color_term_fitting(m_inst_lambda1=m_inst_lambda1, m_inst_lambda2=m_inst_lambda2, beta=beta[...,None], gamma=gamma[...,None]) )/weight
+            residual_std            = np.nanstd(np.where(valid_mask, residual, np.nan), axis=-1)
+            valid_mask_new          = valid_mask & ~(np.abs(residual) > how_many_sigma*residual_std[...,None])
+            if (valid_mask_new == valid_mask).all():
+                break
+            valid_mask              = valid_mask_new
+            fit_result              = color_term_fitting_batch(m_inst_lambda1, m_inst_lambda2, m_true_lambda1, weight, valid_mask, absolute_weight_flag)
+        return fit_result + (valid_mask,)
+    elif refit_mode == "bootstrap":
+        random_generator            = np.random.default_rng(random_seed)
+        N_star                      = m_inst_lambda1.shape[-1]
+        resample_index              = random_generator.integers(0, N_star, size=(bootstrap_number,) + m_inst_lambda1.shape)   # (bootstrap_number, ..., N_star)
+        resample                    = lambda array: np.take_along_axis(np.broadcast_to(array, resample_index.shape), resample_index, axis=-1)
+        beta_bootstrap, gamma_bootstrap = color_term_fitting_batch(resample(m_inst_lambda1), resample(m_inst_lambda2), resample(m_true_lambda1), resample(weight), absolute_weight_flag=absolute_weight_flag)[:2]
+        beta, gamma, _, _, _, reduced_chi2 = fit_result
+        # covariance of the bootstrap (beta, gamma) samples, as np.cov (ddof=1) per fit, skipping degenerate resamplings (NaN fits)
+        sample                      = np.stack([beta_bootstrap, gamma_bootstrap], axis=-1)   # (bootstrap_number, ..., 2)
+        finite_mask                 = np.isfinite(sample).all(axis=-1, keepdims=True)
+        sample_number               = finite_mask.sum(axis=0)[...,None]                      # (..., 1, 1)
+        sample_residual             = np.where(finite_mask, sample - np.nanmean(np.where(finite_mask, sample, np.nan), axis=0), 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            covariance              = (sample_residual[...,:,None]*sample_residual[...,None,:]).sum(axis=0)/(sample_number-1)   # (..., 2, 2)
+        beta_error, gamma_error     = covariance[...,0,0]**0.5, covariance[...,1,1]**0.5
+        return beta, gamma, beta_error, gamma_error, covariance, reduced_chi2, valid_mask
+    else:
+        raise RuntimeError("refit_mode (%s) should be one of %s !! Exit!!"%(refit_mode, str(COLOR_TERM_REFIT_MODE_LIST)))
+
+def color_term_calibration_batch(m_inst_lambda1: np.array, m_inst_lambda2: np.array, m_inst_lambda1_error: np.array, m_inst_lambda2_error: np.array, beta: np.array, gamma: np.array, covariance: np.array) -> tuple:
+    # calibrated magnitude and its error, propagating the (beta, gamma) covariance; beta, gamma are (...) and covariance is (..., 2, 2), broadcast against (..., N_star)
+    beta, gamma                 = np.asarray(beta)[...,None], np.asarray(gamma)[...,None]
+    color                       = np.asarray(m_inst_lambda1) - np.asarray(m_inst_lambda2)
+    m_calibrated                = color_term_fitting(m_inst_lambda1=m_inst_lambda1, m_inst_lambda2=m_inst_lambda2, beta=beta, gamma=gamma)
+    m_calibrated_error          = (  ((1.0+beta)*m_inst_lambda1_error)**2.0 + (beta*m_inst_lambda2_error)**2.0\
+                                   + color**2.0*covariance[...,0,0,None] + covariance[...,1,1,None] + 2.0*color*covariance[...,0,1,None] )**0.5
+    return m_calibrated, m_calibrated_error
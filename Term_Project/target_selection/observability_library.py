@@ -0,0 +1,70 @@
+import functools
+import numpy as np
+
+from astropy                import units as u
+from astropy.coordinates    import EarthLocation, AltAz, get_sun
+from astropy.time           import Time
+
+SIDEREAL_DAY_IN_DAY = 0.99726958   # one sidereal day in unit of solar day
+
+@functools.lru_cache(maxsize=8)
+def get_night_time_grid(night_start_isot: str, night_end_isot: str, time_step_minute: np.float64, longitude_deg: np.float64, latitude_deg: np.float64, height_m: np.float64=0.0) -> tuple:
+    # computed once per night and site: time grid (jd), local sidereal time (deg) and Sun altitude (deg) on the grid
+    night_start, night_end = Time(night_start_isot, scale="utc"), Time(night_end_isot, scale="utc")
+    N_time                 = np.int32(np.ceil((night_end-night_start).to_value(u.min)/time_step_minute)) + 1
+    time_grid              = night_start + np.arange(N_time)*time_step_minute*u.min
+    location               = EarthLocation(lon=longitude_deg*u.deg, lat=latitude_deg*u.deg, height=height_m*u.m)
+    local_sidereal_time    = time_grid.sidereal_time("apparent", longitude=location.lon).to_value(u.deg)
+    sun_altitude           = get_sun(time_grid).transform_to(AltAz(obstime=time_grid, location=location)).alt.to_value(u.deg)
+
+    for array in (local_sidereal_time, sun_altitude):
+        array.setflags(write=False)   # shared by every caller through the cache
+    return time_grid.jd, local_sidereal_time, sun_altitude
+
+def compute_altitude(ra_deg: np.array, dec_deg: np.array, local_sidereal_time: np.array, latitude_deg: np.float64) -> np.array:
+    # (N_target, N_time) altitude in degree from the hour angle, one broadcast over targets and times
+    hour_angle    = np.deg2rad(local_sidereal_time[None,:] - np.asarray(ra_deg, dtype=np.float64)[:,None])
+    dec, latitude = np.deg2rad(np.asarray(dec_deg, dtype=np.float64))[:,None], np.deg2rad(latitude_deg)
+    sin_altitude  = np.sin(dec)*np.sin(latitude) + np.cos(dec)*np.cos(latitude)*np.cos(hour_angle)
+    return np.rad2deg(np.arcsin(np.clip(sin_altitude, -1.0, 1.0)))
+
+def compute_airmass(altitude_deg: np.array) -> np.array:
+    # Pickering (2002) airmass, which stays finite down to the horizon; NaN below the horizon
+    altitude_deg = np.asarray(altitude_deg, dtype=np.float64)
+    airmass      = 1.0/np.sin(np.deg2rad(altitude_deg + 244.0/(165.0 + 47.0*np.clip(altitude_deg, 0.0, None)**1.1)))
+    return np.where(altitude_deg > 0.0, airmass, np.nan)
+
+def compute_transit_time(ra_deg: np.array, time_grid_jd: np.array, local_sidereal_time: np.array) -> np.array:
+    # next transit (jd) after the start of the grid, from the sidereal time at the start and the sidereal rate
+    hour_angle_to_transit = np.mod(np.asarray(ra_deg, dtype=np.float64) - local_sidereal_time[0], 360.)
+    return time_grid_jd[0] + hour_angle_to_transit/360.*SIDEREAL_DAY_IN_DAY
+
+def find_observable_window(observable_mask: np.array) -> tuple:
+    # contiguous True runs of the (N_target, N_time) mask, returned as flat arrays (target_index, start_index, end_index), end_index exclusive
+    padded_mask  = np.pad(observable_mask, ((0,0),(1,1)), mode="constant", constant_values=False).astype(np.int8)
+    edge         = np.diff(padded_mask, axis=1)
+    target_index, start_index = np.nonzero(edge ==  1)
+    _,            end_index   = np.nonzero(edge == -1)   # np.nonzero is row-major, so starts and ends of the same run line up
+    return target_index, start_index, end_index
+
+def plan_night(ra_deg: np.array, dec_deg: np.array, night_start_isot: str, night_end_isot: str, longitude_deg: np.float64, latitude_deg: np.float64, height_m: np.float64=0.0, time_step_minute: np.float64=5.0, altitude_min_deg: np.float64=30.0, sun_altitude_max_deg: np.float64=-12.0) -> dict:
+    # altitude, airmass and transit time of every candidate over the night, plus its observable windows ranked by duration and best airmass
+    time_grid_jd, local_sidereal_time, sun_altitude = get_night_time_grid(night_start_isot, night_end_isot, np.float64(time_step_minute), np.float64(longitude_deg), np.float64(latitude_deg), np.float64(height_m))
+    altitude        = compute_altitude(ra_deg, dec_deg, local_sidereal_time, latitude_deg)
+    airmass         = compute_airmass(altitude)
+    transit_time_jd = compute_transit_time(ra_deg, time_grid_jd, local_sidereal_time)
+    observable_mask = (altitude >= altitude_min_deg) & (sun_altitude <= sun_altitude_max_deg)[None,:]
+
+    target_index, start_index, end_index = find_observable_window(observable_mask)
+    window_duration_minute = (end_index-start_index)*time_step_minute
+    airmass_masked         = np.where(observable_mask, airmass, np.inf).ravel()   # outside the windows airmass is inf, so each reduceat segment only sees its own window
+    window_airmass_min     = np.minimum.reduceat(airmass_masked, target_index*observable_mask.shape[1] + start_index) if target_index.size != 0 else np.array([])
+
+    # rank: longest window first, then the lowest airmass reached within the window
+    window_rank_index      = np.lexsort((window_airmass_min, -window_duration_minute))
+    observable_window_dict = {"target_index": target_index[window_rank_index],
+                              "start_time_jd": time_grid_jd[start_index[window_rank_index]],
+                              "end_time_jd": time_grid_jd[end_index[window_rank_index]-1],
+                              "duration_minute": window_duration_minute[window_rank_index],
+                              "airmass_min": window_airmass_min[window_rank_index]}
+    return {"time_grid_jd": time_grid_jd, "sun_altitude": sun_altitude, "altitude": altitude, "airmass": airmass, "transit_time_jd": transit_time_jd, "observable_mask": observable_mask, "observable_window": observable_window_dict}
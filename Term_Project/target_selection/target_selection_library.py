@@ -0,0 +1,94 @@
+import os
+import json
+import numpy  as np
+import pandas as pd
+
+# columns of the SpecPhoto query in SDSS_data_retrieve_script, ID columns are kept as unsigned 64-bit integers
+SKYSERVER_COLUMN_DTYPE_DICT = {"specObjID": np.uint64, "objID": np.uint64, "run": np.int32, "rerun": np.int32, "camcol": np.int32, "field": np.int32,
+                               "mjd": np.int32, "plate": np.int32, "fiberID": np.int32, "ra": np.float64, "dec": np.float64,
+                               "dered_u": np.float64, "dered_g": np.float64, "dered_i": np.float64, "z": np.float64, "zErr": np.float64, "zWarning": np.int32}
+MISSING_MAGNITUDE = -9999.0    # some data has u, g, i band magnitude as -9999.0, which does not seem to be right
+STORE_INFO_FILENAME = "store_info.json"
+
+def read_skyserver_csv(csv_filename: str, chunk_size: np.int32=1000000) -> dict:
+    # parse the SkyServer export in chunks with explicit dtypes, skip row: "#Table 1"
+    column_list_dict = {}
+    for df_chunk in pd.read_csv(csv_filename, delimiter=",", skiprows=1, chunksize=chunk_size, dtype=SKYSERVER_COLUMN_DTYPE_DICT):
+        for column in df_chunk.columns:
+            column_list_dict.setdefault(column, []).append(df_chunk[column].to_numpy())
+    return {column: np.concatenate(column_list) for column, column_list in column_list_dict.items()}
+
+def add_derived_column(column_dict: dict) -> dict:
+    dered_ugi                        = np.stack([column_dict["dered_u"], column_dict["dered_g"], column_dict["dered_i"]], axis=0)
+    column_dict["dered_ugi_mean"]    = dered_ugi.mean(axis=0)
+    column_dict["clean_flag"]        = (dered_ugi != MISSING_MAGNITUDE).all(axis=0)
+    return column_dict
+
+def convert_skyserver_csv_to_columnar_store(csv_filename: str, store_folder: str, chunk_size: np.int32=1000000, verbose: bool=False) -> str:
+    # rows are stored sorted by RA (so an RA window is a contiguous slice); the Dec and dered_ugi_mean orders are stored as index arrays
+    column_dict         = add_derived_column(read_skyserver_csv(csv_filename, chunk_size=chunk_size))
+    ra_sort_index       = np.argsort(column_dict["ra"], kind="stable")
+    column_dict         = {column: array[ra_sort_index] for column, array in column_dict.items()}
+    column_dict["dec_sort_index"]            = np.argsort(column_dict["dec"],            kind="stable").astype(np.int64)
+    column_dict["dered_ugi_mean_sort_index"] = np.argsort(column_dict["dered_ugi_mean"], kind="stable").astype(np.int64)
+
+    os.makedirs(store_folder, exist_ok=True)
+    for column, array in column_dict.items():
+        np.save("%s/%s.npy"%(store_folder, column), np.ascontiguousarray(array))
+    with open("%s/%s"%(store_folder, STORE_INFO_FILENAME), "w") as store_info_file:
+        json.dump({"source_csv": os.path.abspath(csv_filename), "row_number": int(ra_sort_index.size), "column_list": list(column_dict.keys())}, store_info_file, indent=1)
+    if verbose:
+        print("Convert %d rows of %s to %s ."%(ra_sort_index.size, csv_filename, store_folder))
+    return store_folder
+
+def load_columnar_store(store_folder: str) -> dict:
+    # memory-mapped, so only the pages touched by a query are read from disk
+    with open("%s/%s"%(store_folder, STORE_INFO_FILENAME), "r") as store_info_file:
+        store_info = json.load(store_info_file)
+    return {column: np.load("%s/%s.npy"%(store_folder, column), mmap_mode="r") for column in store_info["column_list"]}
+
+def query_sorted_range(sorted_array: np.array, value_min: np.float64, value_max: np.float64, sorter: np.array=None) -> tuple:
+    # sorter (argsort of sorted_array) lets an unsorted column be searched without gathering it in sorted order, only O(log N) elements are read
+    return np.searchsorted(sorted_array, value_min, side="left", sorter=sorter), np.searchsorted(sorted_array, value_max, side="right", sorter=sorter)
+
+def query_ra_range(store: dict, ra_min: np.float64, ra_max: np.float64) -> np.array:
+    # rows with ra_min <= ra <= ra_max (in degree); ra_min > ra_max means the window wraps through RA = 0
+    ra = store["ra"]
+    if ra_min <= ra_max:
+        index_start, index_end = query_sorted_range(ra, ra_min, ra_max)
+        return np.arange(index_start, index_end)
+    else:
+        index_start, _         = query_sorted_range(ra, ra_min, 24*15)
+        _, index_end           = query_sorted_range(ra, 0.0, ra_max)
+        return np.concatenate([np.arange(index_start, ra.size), np.arange(0, index_end)])
+
+def query_target(store: dict, ra_min: np.float64, ra_max: np.float64, dec_min: np.float64=-90., dec_max: np.float64=90., dered_ugi_mean_max: np.float64=None, clean_flag: bool=True) -> np.array:
+    # row indices of the targets within the RA/Dec window and the magnitude cut, sorted by dered_ugi_mean (brightest first)
+    ra_index              = query_ra_range(store, ra_min, ra_max)
+    dec_sort_index        = store["dec_sort_index"]
+    dec_index_start, dec_index_end = query_sorted_range(store["dec"], dec_min, dec_max, sorter=dec_sort_index)
+
+    # start from the narrower of the two range lookups and mask the other condition on that subset only
+    if ra_index.size <= dec_index_end-dec_index_start:
+        index             = ra_index[(dec_min <= store["dec"][ra_index]) & (store["dec"][ra_index] <= dec_max)]
+    else:
+        index             = np.asarray(dec_sort_index[dec_index_start:dec_index_end])
+        ra                = store["ra"][index]
+        index             = index[((ra_min <= ra) & (ra <= ra_max)) if ra_min <= ra_max else ((ra_min <= ra) | (ra <= ra_max))]
+
+    if clean_flag:
+        index             = index[store["clean_flag"][index]]
+    dered_ugi_mean        = store["dered_ugi_mean"][index]
+    if dered_ugi_mean_max is not None:
+        index, dered_ugi_mean = index[dered_ugi_mean <= dered_ugi_mean_max], dered_ugi_mean[dered_ugi_mean <= dered_ugi_mean_max]
+    return index[np.argsort(dered_ugi_mean, kind="stable")]
+
+def query_brightest_target(store: dict, target_number: np.int32, clean_flag: bool=True) -> np.array:
+    # brightest targets over the whole sky straight from the dered_ugi_mean order
+    index = np.asarray(store["dered_ugi_mean_sort_index"])
+    if clean_flag:
+        index = index[store["clean_flag"][index]]
+    return index[:target_number]
+
+def convert_store_to_dataframe(store: dict, index: np.array, column_list: list=["objID","dered_ugi_mean","plate","fiberID","mjd","ra","dec"]) -> pd.DataFrame:
+    return pd.DataFrame({column: store[column][index] for column in column_list})